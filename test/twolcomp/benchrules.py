@@ -0,0 +1,166 @@
+"""benchrules.py -- a micro-benchmark for compiling two-level rules
+
+For each <=> rule of the grammar, the rule is compiled in two ways:
+
+separate -- as a => rule and a <= rule whose results are then combined,
+which is how twrule.doublearrow() used to compile the rules
+
+shared -- by twrule.doublearrow() which computes the conditions that
+both parts need only once
+
+The memo of context conditions is cleared before each compilation, so
+both ways start from scratch.  When in this directory, run e.g.:
+
+    $ python3 benchrules.py -e grada.pstr -r grada.twol
+
+With --contexts, the script instead compares two ways of combining the
+conditions of many contexts in twrule.contexts_to_condition():
+
+stepwise -- adding one context at a time and minimizing after each
+
+balanced -- combining all contexts with a balanced tree of unions
+
+The contexts are made of pairs of surface symbols, e.g. ':a _ :e', and
+the memo is filled before timing so that only the combining is timed:
+
+    $ python3 benchrules.py -e grada.pstr --contexts 1 10 100
+"""
+
+import time
+
+import hfst as hfst
+
+import twol.cfg as cfg
+import twol.twexamp as twexamp
+import twol.twrule as twrule
+import twol.twolcomp as twolcomp
+from twol.twparser import init as twparser_init
+from twol.twparser import parse_rule
+
+
+def separate(name, x_fst, *contexts):
+    """Compiles a <=> rule as two separate rules and combines them"""
+    rule_fst, selector_fst, scrambler_fst = twrule.rightarrow(
+        name, x_fst, *contexts)
+    rule2_fst, selector2_fst, scrambler2_fst = twrule.output_coercion(
+        name, x_fst, *contexts)
+    rule_fst.intersect(rule2_fst)
+    rule_fst.minimize()
+    scrambler_fst.disjunct(scrambler2_fst)
+    scrambler_fst.minimize()
+    selector_fst.disjunct(selector2_fst)
+    selector_fst.minimize()
+    return rule_fst, selector_fst, scrambler_fst
+
+
+def stepwise(*contexts):
+    """Combines the context conditions one at a time"""
+    result_fst = hfst.HfstTransducer()
+    for leftc, rightc in contexts:
+        context_fst = twrule.context_to_condition(leftc, rightc)
+        result_fst.disjunct(context_fst)
+        result_fst.minimize()
+    return result_fst
+
+
+def surface_contexts(count):
+    """Returns count contexts like ':a _ :e' out of the surface symbols"""
+    outsym_lst = sorted(sym for sym in cfg.output_symbol_set
+                        if sym.isalpha() and sym != "Ø")
+    context_lst = []
+    for left in outsym_lst:
+        for right in outsym_lst:
+            if len(context_lst) == count:
+                return context_lst
+            leftc = hfst.regex("?:%" + left)
+            leftc.compose(cfg.all_pairs_fst)
+            rightc = hfst.regex("?:%" + right)
+            rightc.compose(cfg.all_pairs_fst)
+            leftc.minimize()
+            rightc.minimize()
+            context_lst.append((leftc, rightc))
+    return context_lst
+
+
+def bench_contexts(count_lst, repeat):
+    """Times the two ways of combining a number of contexts"""
+    print("{:>8} {:>10} {:>10} {:>8}".format(
+        "contexts", "stepwise", "balanced", "speedup"))
+    for count in count_lst:
+        context_lst = surface_contexts(count)
+        if len(context_lst) < count:
+            print("only", len(context_lst), "contexts available")
+        twrule.contexts_to_condition(*context_lst)  # fills the memo
+        time1, result1 = best_time(stepwise, repeat, *context_lst,
+                                   clear_memo=False)
+        time2, result2 = best_time(twrule.contexts_to_condition, repeat,
+                                   *context_lst, clear_memo=False)
+        if not result1.compare(result2):
+            print("** the results differ for", count, "contexts")
+        print("{:8d} {:8.1f}ms {:8.1f}ms {:7.2f}x".format(
+            len(context_lst), 1000 * time1, 1000 * time2, time1 / time2))
+    return
+
+
+def best_time(function, repeat, *args, clear_memo=True):
+    """Returns the shortest time of the calls and the last result"""
+    best = None
+    for i in range(repeat):
+        if clear_memo:
+            twrule.context_memo.clear()
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    import argparse
+    arpar = argparse.ArgumentParser(
+        description="Compares the ways of compiling <=> rules")
+    arpar.add_argument("-e", "--examples", nargs='+',
+                       default=["grada.pstr"])
+    arpar.add_argument("-r", "--rules", nargs='+',
+                       default=["grada.twol"])
+    arpar.add_argument("-n", "--repeat", type=int, default=5,
+                       help="number of times each rule is compiled")
+    arpar.add_argument("--contexts", type=int, nargs='+',
+                       help="numbers of contexts for timing the"
+                       " combining of context conditions")
+    args = arpar.parse_args()
+
+    twexamp.read_examples(args.examples)
+    parser = twparser_init()
+    twrule.init()
+    twrule.require_base()
+    if args.contexts:
+        bench_contexts(args.contexts, args.repeat)
+        return
+
+    total_separate = total_shared = 0.0
+    print("{:>10} {:>10} {:>8}  rule".format("separate", "shared", "speedup"))
+    for rule_str, line_no, line_nl_lst in twolcomp.rule_statements(
+            args.rules):
+        op, left, right = parse_rule(parser, rule_str, line_no, line_nl_lst)
+        if op != "<=>":
+            continue
+        time1, result1 = best_time(separate, args.repeat,
+                                   rule_str, left, *right)
+        time2, result2 = best_time(twrule.doublearrow, args.repeat,
+                                   rule_str, left, *right)
+        if not all(fst1.compare(fst2)
+                   for fst1, fst2 in zip(result1, result2)):
+            print("** the results differ for:", rule_str)
+        total_separate += time1
+        total_shared += time2
+        print("{:8.1f}ms {:8.1f}ms {:7.2f}x  {}".format(
+            1000 * time1, 1000 * time2, time1 / time2, rule_str[:40]))
+    if total_shared:
+        print("{:8.1f}ms {:8.1f}ms {:7.2f}x  total".format(
+            1000 * total_separate, 1000 * total_shared,
+            total_separate / total_shared))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ __all__ = [
     "twolcomp",
     "twparser",
     "twrule",
+    "rulecache",
     "discover",
     "aligner",
     "alphabet",
@@ -9,6 +9,10 @@ __author__ = """© Kimmo Koskenniemi, 2018, 2022"""
 
 import re
 
+from array import array
+
+from collections import defaultdict
+
 verbosity = 0
 
 all_zero_weight = 1000.0
@@ -41,6 +45,14 @@ pair_symbol_set = set()
 """The set of all normalized pair symbols (e.g. 'k', '{aä}:a')
 occurring in the examples"""
 
+insym2pairsym_set = defaultdict(set)
+"""For each input symbol, the set of pair symbols in pair_symbol_set
+which have that input symbol"""
+
+outsym2pairsym_set = defaultdict(set)
+"""For each output symbol, the set of pair symbols in pair_symbol_set
+which have that output symbol"""
+
 examples_fst = None
 """Examples as a tranducer that accepts them as symbol pair sequences"""
 
@@ -64,12 +76,103 @@ def pairsym2sympair(pairsym):
     pairsym -- a pair symbol, e.g. 'k' or '{aä}:a' or 'k:k'
 
     returns -- a symbol pair, e.g. ('k', 'k') or ('{aä}', 'a') or ('k','k')
+
+    The pair symbol is interned with pairsym_id(), so that it is
+    analyzed only once.
     """
-    m = re.match(r"^([^:]*):([^:]*)$", pairsym)
-    if m:
-        return(m.group(1), m.group(2))
-    else:
-        return(pairsym, pairsym)
+    return sympair_lst[pairsym_id(pairsym)]
+
+pairsym_id_dict = {}
+"""Interned pair symbols: gives a small int id for each pair symbol
+which has been seen; e.g. 'k' and 'k:k' have the same id"""
+
+sympair_id_dict = {}
+"""Gives the id of the pair symbol of a symbol pair, e.g. ('k', 'k')"""
+
+pairsym_lst = []
+"""The normalized pair symbol of each pair symbol id"""
+
+sympair_lst = []
+"""The symbol pair of each pair symbol id"""
+
+insym_id_dict = {}
+"""Gives a small int id for each interned input symbol"""
+
+insym_lst = []
+"""The input symbol of each input symbol id"""
+
+outsym_id_dict = {}
+"""Gives a small int id for each interned output symbol"""
+
+outsym_lst = []
+"""The output symbol of each output symbol id"""
+
+pair_insym_ids = array("I")
+"""The input symbol id of each pair symbol id"""
+
+pair_outsym_ids = array("I")
+"""The output symbol id of each pair symbol id"""
+
+def insym_id(insym):
+    """Returns the id of an input symbol, interning it if it is new"""
+    if insym not in insym_id_dict:
+        insym_id_dict[insym] = len(insym_lst)
+        insym_lst.append(insym)
+    return insym_id_dict[insym]
+
+def outsym_id(outsym):
+    """Returns the id of an output symbol, interning it if it is new"""
+    if outsym not in outsym_id_dict:
+        outsym_id_dict[outsym] = len(outsym_lst)
+        outsym_lst.append(outsym)
+    return outsym_id_dict[outsym]
+
+def sympair_id(insym, outsym):
+    """Returns the id of a symbol pair, interning it if it is new"""
+    sympair = (insym, outsym)
+    if sympair not in sympair_id_dict:
+        sympair_id_dict[sympair] = len(sympair_lst)
+        sympair_lst.append(sympair)
+        pairsym_lst.append(sympair2pairsym(insym, outsym))
+        pair_insym_ids.append(insym_id(insym))
+        pair_outsym_ids.append(outsym_id(outsym))
+    return sympair_id_dict[sympair]
+
+def pairsym_id(pairsym):
+    """Returns the id of a pair symbol, interning it if it is new
+
+    pairsym -- a pair symbol, e.g. 'k' or '{aä}:a' or 'k:k'
+    """
+    if pairsym not in pairsym_id_dict:
+        m = re.match(r"^([^:]*):([^:]*)$", pairsym)
+        if m:
+            pairsym_id_dict[pairsym] = sympair_id(m.group(1), m.group(2))
+        else:
+            pairsym_id_dict[pairsym] = sympair_id(pairsym, pairsym)
+    return pairsym_id_dict[pairsym]
+
+def pairsyms_to_ids(pairsym_seq):
+    """Converts a sequence of pair symbols into an array of their ids"""
+    return array("I", [pairsym_id(pairsym) for pairsym in pairsym_seq])
+
+def pairstr_to_ids(pairstr):
+    """Converts a space-separated string of pair symbols into an array
+    of their ids"""
+    return pairsyms_to_ids(pairstr.split())
+
+def ids_to_pairsyms(id_seq):
+    """Converts a sequence of pair symbol ids into normalized pair
+    symbols"""
+    return [pairsym_lst[i] for i in id_seq]
+
+def ids_to_pairstr(id_seq):
+    """Converts a sequence of pair symbol ids into a space-separated
+    string of normalized pair symbols"""
+    return " ".join([pairsym_lst[i] for i in id_seq])
+
+def ids_to_sympairs(id_seq):
+    """Converts a sequence of pair symbol ids into symbol pairs"""
+    return [sympair_lst[i] for i in id_seq]
 
 def sympair2pairsym(insym, outsym):
     """Converts a symbol pair into a corresponding normalized pair symbol
@@ -85,5 +188,30 @@ def sympair2pairsym(insym, outsym):
     else:
         return(insym + ':' + outsym)
 
+def cache_directory():
+    """Returns the directory for files which are cached between runs
+
+    The directory is $TWOL_CACHE_DIR if that is set, otherwise 'twol'
+    under $XDG_CACHE_HOME or ~/.cache.  If TWOL_CACHE_DIR is set to an
+    empty string, an empty string is returned and nothing is cached.
+    """
+    import os
+    if "TWOL_CACHE_DIR" in os.environ:
+        return os.environ["TWOL_CACHE_DIR"]
+    cache_home = (os.environ.get("XDG_CACHE_HOME") or
+                  os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "twol")
+
+def pair_alphabet_digest():
+    """Returns a hex digest which identifies the current symbol_pair_set
+
+    The digest is used as a part of keys of files which are cached
+    between runs and which are valid only for this pair alphabet.
+    """
+    import hashlib
+    pair_str = "\n".join(sorted(insym + ":" + outsym
+                                for insym, outsym in symbol_pair_set))
+    return hashlib.sha256(pair_str.encode("utf-8")).hexdigest()
+
 if __name__ == "__main__":
     print("cgf module is not meant to be used as a script")
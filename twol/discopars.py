@@ -16,15 +16,11 @@ from tatsu.exceptions import ParseException, FailedParse, ParseError, FailedSema
 
 import twol.cfg as cfg
 import twol.twexamp as twexamp
+from twol.twparser import cached_parser
 
 from collections import deque, defaultdict
 from typing import List, Dict, Set, Tuple, DefaultDict
 
-insym2pairsym_set: DefaultDict[str, set] = defaultdict(set)
-# key: input symbol, value: set of pair symbols
-
-outsym2pairsym_set: DefaultDict[str, set] = defaultdict(set)
-# key: output symbol, value: set of pair symbols
 
 
 class DiscovDefSemantics(object):
@@ -63,9 +59,8 @@ class DiscovDefSemantics(object):
         for pairsym in pairsym_set:
             insym, outsym = cfg.pairsym2sympair(pairsym)
             insym_set.add(insym)
-        for insymbol, outsymbol in cfg.symbol_pair_set:
-            if insymbol in insym_set:
-                result_set.add(cfg.sympair2pairsym(insymbol, outsymbol))
+        for insym in insym_set:
+            result_set |= cfg.insym2pairsym_set.get(insym, set())
         # print(f"in Morphophonemic: {result_set = }") ####
         return result_set
 
@@ -82,9 +77,8 @@ class DiscovDefSemantics(object):
         for pairsym in pairsym_set:
             insym, outsym = cfg.pairsym2sympair(pairsym)
             outsym_set.add(outsym)
-        for insymbol, outsymbol in cfg.symbol_pair_set:
-            if outsymbol in outsym_set:
-                result_set.add(cfg.sympair2pairsym(insymbol, outsymbol))
+        for outsym in outsym_set:
+            result_set |= cfg.outsym2pairsym_set.get(outsym, set())
         return result_set
 
     def pair(self, ast):
@@ -111,16 +105,10 @@ class DiscovDefSemantics(object):
             result_set = set([f"{up}:{lo}"])
             return result_set
         elif up and (not lo):   # it is e.g. "{aØ}:"
-            result_set = set()
-            for insym, outsym in cfg.symbol_pair_set:
-                if insym == up:
-                    result_set.add(cfg.sympair2pairsym(insym, outsym))
+            result_set = cfg.insym2pairsym_set.get(up, set()).copy()
             return result_set
         elif (not up) and lo:   # it is e.g. ":i"
-            result_set = set()
-            for insym, outsym in cfg.symbol_pair_set:
-                if outsym == lo:
-                    result_set.add(cfg.sympair2pairsym(insym, outsym))
+            result_set = cfg.outsym2pairsym_set.get(lo, set()).copy()
             return result_set
         else:                   # it is ":"
             result_set = cfg.pair_symbol_set.copy()
@@ -213,7 +201,7 @@ def init():
     for rules
     """
     # print("in init:", ebnf_str) ####
-    parser = compile(ebnf_str, trace=False)
+    parser = cached_parser(ebnf_str, "DiscovDefSyntax")
     return parser
 
 def parse_defs(parser, defs_filename):
@@ -267,11 +255,6 @@ def main():
 
     twexamp.read_examples(filename_lst=[args.examples], build_fsts=False)
 
-    for insym, outsym in cfg.symbol_pair_set:
-        pair_symbol = cfg.sympair2pairsym(insym, outsym)
-        insym2pairsym_set[insym].add(pair_symbol)
-        outsym2pairsym_set[outsym].add(pair_symbol)
-
     parser = init()
     parse_defs(parser, args.definitions)
     
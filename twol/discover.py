@@ -29,11 +29,8 @@ SymPair = Tuple[str, str]
 Result = Dict
 ResultList = List[Result]
 
-insym2pairsym_set: DefaultDict[str, set] = defaultdict(set)
-# key: input symbol, value: set of pair symbols
-
-outsym2pairsym_set: DefaultDict[str, set] = defaultdict(set)
-# key: output symbol, value: set of pair symbols
+from twol.cfg import insym2pairsym_set, outsym2pairsym_set
+# built by twexamp, key: input/output symbol, value: set of pair symbols
 
 positive_context_set = {}
 negative_context_set = {}
@@ -360,6 +357,58 @@ def overlap(set_lst: list[str],
     #print(f"in overlap: return False") #####
     return False
 
+context_ids_dict: Dict[Tuple[str, bool], Tuple[int, ...]] = {}
+"""Contexts converted into tuples of pair symbol ids by context_ids()"""
+
+def context_ids(context_str: str, reverse: bool) -> Tuple[int, ...]:
+    """Converts a context of pair symbols into a tuple of their ids
+
+    :param context_str: A space-separated string of pair symbols
+
+    :param reverse: If True, the order of the symbols is reversed as is needed for left contexts
+
+    The result is memoized because the same negative contexts are compared again and again.
+    """
+    key = (context_str, reverse)
+    if key not in context_ids_dict:
+        ids = cfg.pairstr_to_ids(context_str)
+        context_ids_dict[key] = tuple(reversed(ids) if reverse else ids)
+    return context_ids_dict[key]
+
+set_ids_dict: Dict[str, frozenset] = {}
+"""Pair symbols and set names converted into sets of pair symbol ids"""
+
+def set_ids(name: str) -> frozenset:
+    """Returns the ids of the pair symbols in a defined set or of a pair symbol"""
+    if name not in set_ids_dict:
+        if name in cfg.definitions:
+            set_ids_dict[name] = frozenset(
+                cfg.pairsym_id(pairsym) for pairsym in cfg.definitions[name])
+        else:
+            set_ids_dict[name] = frozenset([cfg.pairsym_id(name)])
+    return set_ids_dict[name]
+
+def rule_context_sets(context_str: str, reverse: bool) -> List[frozenset]:
+    """Converts a context of pair symbols and set names into a list of
+    sets of pair symbol ids"""
+    name_lst = context_str.split()
+    if reverse:
+        name_lst.reverse()
+    return [set_ids(name) for name in name_lst]
+
+def overlap_ids(set_lst: List[frozenset],
+                id_lst: Tuple[int, ...]) -> bool:
+    """Tests whether list of sets of ids covers a sequence of pair symbol ids
+
+    The same as overlap() but for contexts converted by rule_context_sets() and context_ids().
+    """
+    if len(set_lst) > len(id_lst):
+        return False
+    for id_set, pair_id in zip(set_lst, id_lst):
+        if pair_id not in id_set:
+            return False
+    return True
+
 def pos_neg_is_disjoint(rule_ctx_set: ContextSet,
                         other_ctx_set: ContextSet) -> bool:
     """
@@ -372,24 +421,17 @@ def pos_neg_is_disjoint(rule_ctx_set: ContextSet,
     :returns:  True if the context sets are logically disjoint.
 
 """
-    #print_context_set(f"in pos_neg_is_disjoint: {pair_symbol = }",
-    #                  rule_ctx_set) #####
+    neg_ids_lst = [(context_ids(neg_left_str, True),
+                    context_ids(neg_rght_str, False))
+                   for neg_left_str, neg_rght_str in other_ctx_set]
     for rule_left_str, rule_rght_str in rule_ctx_set:
-        rule_left_lst = list(reversed(rule_left_str.split()))
-        #print(f"in rule_neg_is_disjoint: {rule_left_lst = }") #####
-        rule_rght_lst = rule_rght_str.split()
-        #print(f"in pos_neg_is_disjoint: {rule_rght_lst = }") #####
-        for neg_left_str, neg_rght_str in other_ctx_set:
-            neg_left_lst = list(reversed(neg_left_str.split()))
-            neg_rght_lst = neg_rght_str.split()
-            if (overlap(rule_left_lst, neg_left_lst)
+        rule_left_lst = rule_context_sets(rule_left_str, True)
+        rule_rght_lst = rule_context_sets(rule_rght_str, False)
+        for neg_left_ids, neg_rght_ids in neg_ids_lst:
+            if (overlap_ids(rule_left_lst, neg_left_ids)
                 and
-                overlap(rule_rght_lst, neg_rght_lst)):
-                #print(f"{rule_left_lst} _ {rule_rght_lst}") #####
-                #print(f"{neg_left_lst} _ {neg_rght_lst}\n") #####
-                #print("in rule_neg_is_disjoint: return False") #####
+                overlap_ids(rule_rght_lst, neg_rght_ids)):
                 return(False)
-    #print("in pos_neg_is_disjoint: return True\n") #####
     return True
     
 def pos_neg_is_subset(rule_ctx_set: ContextSet,
@@ -404,25 +446,19 @@ def pos_neg_is_subset(rule_ctx_set: ContextSet,
     :returns: True if all context in the first set match some context in the second set.  
 
 """
-    #print_context_set("in pos_neg_is_subset, neg set", ctx_set) #####
+    neg_ids_lst = [(context_ids(neg_left_str, True),
+                    context_ids(neg_rght_str, False))
+                   for neg_left_str, neg_rght_str in ctx_set]
     for rule_left_str, rule_rght_str in rule_ctx_set:
-        rule_left_lst = list(reversed(rule_left_str.split()))
-        #print(f"in pos_neg_is_subset: {rule_left_lst = }") #####
-        rule_rght_lst = rule_rght_str.split()
-        #print(f"in pos_neg_is_subset: {rule_rght_lst = }") #####
-        for neg_left_str, neg_rght_str in ctx_set:
-            neg_left_lst = list(reversed(neg_left_str.split()))
-            #print(f"in pos_neg_is_subset: {neg_left_lst = }") #####
-            neg_rght_lst = neg_rght_str.split()
-            #print(f"in pos_neg_is_subset: {neg_rght_lst = }") #####
-            if (overlap(rule_left_lst, neg_left_lst)
+        rule_left_lst = rule_context_sets(rule_left_str, True)
+        rule_rght_lst = rule_context_sets(rule_rght_str, False)
+        for neg_left_ids, neg_rght_ids in neg_ids_lst:
+            if (overlap_ids(rule_left_lst, neg_left_ids)
                 and
-                overlap(rule_rght_lst, neg_rght_lst)):
+                overlap_ids(rule_rght_lst, neg_rght_ids)):
                 break
         else:
-            #print("in pos_neg_is_subset: return False\n") #####
             return False
-    #print("in pos_neg_is_subset: return True\n") #####
     return True
     
 
@@ -635,7 +671,6 @@ def main():
     
     version = cfg.timestamp(__file__)
 
-    global outsym2pairsym_set
     import argparse
     import json
     import os
@@ -688,10 +723,6 @@ def main():
     if cfg.verbosity >= 10:
         print("--- all examples read in ---")
 
-    for insym, outsym in symbol_pair_set:
-        pair_symbol = sympair2pairsym(insym, outsym)
-        insym2pairsym_set[insym].add(pair_symbol)
-        outsym2pairsym_set[outsym].add(pair_symbol)
     for insym, symset in insym2pairsym_set.items():
         cfg.definitions[insym + ":"] = symset
     for outsym, symset in outsym2pairsym_set.items():
@@ -56,6 +56,30 @@ def union(f, g):
     res.minimize()
     return res
 
+def union_lst(fst_lst):
+    """Return the union of a list of FSTs
+
+    The FSTs are combined pairwise in a balanced tree, so that each
+    intermediate result is minimized once and the FSTs being combined
+    are of similar sizes.  An empty list gives an empty FST.
+    """
+    if not fst_lst:
+        return hfst.empty_fst()
+    level_lst = [fst.copy() for fst in fst_lst]
+    while len(level_lst) > 1:
+        next_lst = []
+        for i in range(0, len(level_lst) - 1, 2):
+            res = level_lst[i]
+            res.disjunct(level_lst[i + 1])
+            res.minimize()
+            next_lst.append(res)
+        if len(level_lst) % 2:
+            next_lst.append(level_lst[-1])
+        level_lst = next_lst
+    res = level_lst[0]
+    res.minimize()
+    return res
+
 def intersect(f, g):
     """Return the intersection of two FSTs
 
@@ -115,6 +139,38 @@ def string_to_fsa(grapheme_string):
     if cfg.verbosity >= 10:
         print(fsa)
     return(fsa)
-    
+
+def fst_to_bytes(fst):
+    """Return the FST in the HFST binary format as a bytes object
+
+    HFST transducers cannot be pickled, so this is used for passing
+    them between processes.
+    """
+    import os
+    import tempfile
+    fd, file_name = tempfile.mkstemp(suffix=".fst")
+    os.close(fd)
+    try:
+        fst.write_to_file(file_name)
+        with open(file_name, "rb") as fil:
+            return fil.read()
+    finally:
+        os.remove(file_name)
+
+def bytes_to_fst(data):
+    """Return an FST out of bytes produced by fst_to_bytes()"""
+    import os
+    import tempfile
+    fd, file_name = tempfile.mkstemp(suffix=".fst")
+    with os.fdopen(fd, "wb") as fil:
+        fil.write(data)
+    try:
+        istream = hfst.HfstInputStream(file_name)
+        fst = istream.read()
+        istream.close()
+        return fst
+    finally:
+        os.remove(file_name)
+
 if __name__ == "__main__":
     print("fs module is not meant to be used as a script")
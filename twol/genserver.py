@@ -0,0 +1,290 @@
+"""genserver.py
+
+A server which keeps the rule tables of twgenerate resident and
+answers requests for generating or analyzing words.  The server is
+started with ``twol-generate --serve SOCKET``, or with
+``twol-generate --serve -`` which reads requests from stdin and writes
+the responses to stdout instead of the Unix socket.
+
+Each request and each response is one line of JSON, e.g.::
+
+  {"id": 1, "op": "generate", "words": ["h{aØ}m{pm}{aØ}s", "k{aØ}{td}un"]}
+  {"id": 1, "results": [["hammas"], ["kadun"]]}
+
+The "op" is "generate" (the default), "analyze" or "stats".  Instead
+of "words" a request may have one "word" and then the response has
+one "result".  The "stats" request gives the counters of the server
+and, if the Generator has a result cache, its counters in "cache".
+The "id" can be any JSON value and it is copied into the response.
+Requests may be pipelined, i.e. a client need not wait for a response
+before sending the next request.  The requests are processed by a
+pool of threads and a response is written as soon as it is ready, so
+the responses may come in a different order than the requests.
+
+This is free software according to GNU GPL 3 license.
+"""
+
+import json
+
+import sys
+
+import time
+
+import threading
+
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from typing import List, Dict, Optional
+
+
+class ServerStats(object):
+    """Throughput and latency counters of a Server
+
+    The latency of a request is the time from reading the request to
+    having its response ready, including the time it waited for a
+    thread.  The percentiles are computed from the latencies of the
+    most recent requests.
+    """
+
+    def __init__(self, recent_count: int = 10000):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.words = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.recent_latencies: deque = deque(maxlen=recent_count)
+
+    def record(self, word_count: int, latency: float, error: bool) -> None:
+        """Counts one request"""
+        with self.lock:
+            self.requests += 1
+            self.words += word_count
+            if error:
+                self.errors += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.recent_latencies.append(latency)
+        return
+
+    def as_dict(self) -> Dict[str, float]:
+        """Returns the counters and the figures computed from them"""
+        with self.lock:
+            uptime = time.perf_counter() - self.start_time
+            recent = sorted(self.recent_latencies)
+            requests = self.requests
+
+            def percentile(fraction: float) -> float:
+                if not recent:
+                    return 0.0
+                return recent[min(len(recent) - 1,
+                                  int(fraction * len(recent)))] * 1000
+
+            return {"uptime_s": round(uptime, 3),
+                    "requests": requests,
+                    "words": self.words,
+                    "errors": self.errors,
+                    "requests_per_s": round(requests / uptime, 1),
+                    "words_per_s": round(self.words / uptime, 1),
+                    "latency_mean_ms": round(self.latency_sum * 1000 /
+                                             requests, 3)
+                                       if requests else 0.0,
+                    "latency_p50_ms": round(percentile(0.5), 3),
+                    "latency_p99_ms": round(percentile(0.99), 3),
+                    "latency_max_ms": round(self.latency_max * 1000, 3)}
+
+
+class Server(object):
+    """Answers the requests of one or more streams with a Generator
+
+    generator -- a twgenerate.Generator whose rules have been loaded
+
+    threads -- the number of threads which process the requests
+    """
+
+    def __init__(self, generator, threads: int = 4):
+        self.generator = generator
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.stats = ServerStats()
+
+    def answer(self, request_line: bytes, start: float) -> bytes:
+        """Processes one request and returns its response line"""
+        request_id = None
+        word_count = 0
+        try:
+            request = json.loads(request_line)
+            if not isinstance(request, dict):
+                raise ValueError("a request must be a JSON object")
+            request_id = request.get("id")
+            op = request.get("op", "generate")
+            if op == "stats":
+                response = {"id": request_id, "stats": self.stats.as_dict()}
+                if self.generator.result_cache_size:
+                    response["cache"] = self.generator.result_cache_info()
+            elif op in ("generate", "analyze"):
+                many = (self.generator.analyze_many if op == "analyze"
+                        else self.generator.generate_many)
+                if "word" in request:
+                    word_count = 1
+                    response = {"id": request_id,
+                                "result": many([request["word"]])[0]}
+                else:
+                    words = request.get("words", [])
+                    word_count = len(words)
+                    response = {"id": request_id, "results": many(words)}
+            else:
+                raise ValueError("unknown op: {}".format(op))
+            error = False
+        except Exception as exc:
+            response = {"id": request_id, "error": str(exc)}
+            error = True
+        self.stats.record(word_count, time.perf_counter() - start, error)
+        return (json.dumps(response, ensure_ascii=False) +
+                "\n").encode("utf-8")
+
+    def serve_stream(self, in_file, out_file) -> None:
+        """Answers the requests of a binary stream until it ends
+
+The requests are given to the threads as soon as they are read and
+each response is written when it is ready.  Returns when all responses
+have been written.
+"""
+        write_lock = threading.Lock()
+        pending = set()
+
+        def write_response(future) -> None:
+            with write_lock:
+                try:
+                    out_file.write(future.result())
+                    out_file.flush()
+                except (OSError, ValueError):
+                    pass        # the client has gone
+            return
+
+        for request_line in in_file:
+            if not request_line.strip():
+                continue
+            future = self.executor.submit(self.answer, request_line,
+                                          time.perf_counter())
+            future.add_done_callback(write_response)
+            pending.add(future)
+            if len(pending) > 1000:
+                pending = {fut for fut in pending if not fut.done()}
+        wait(pending)
+        return
+
+    def serve_socket(self, socket_path: str) -> None:
+        """Answers the requests of clients connecting to a Unix socket
+
+Each connection is served by a thread of its own and its requests are
+processed by the common threads of the Server.  An existing file at
+socket_path is replaced.  Serves until interrupted or terminated.
+"""
+        import os
+        import signal
+        import socketserver
+        server = self
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, terminate)
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve_stream(self.rfile, self.wfile)
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path,
+                                                    Handler) as unix_server:
+            unix_server.daemon_threads = True
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.unlink(socket_path)
+        return
+
+    def report(self, file=sys.stderr) -> None:
+        """Prints the counters"""
+        print(", ".join("{} {}".format(name, value) for name, value
+                        in self.stats.as_dict().items()), file=file)
+        return
+
+
+def serve(generator, socket_path: str = "-", threads: int = 4) -> None:
+    """Serves requests on a Unix socket or, if socket_path is "-", on
+stdin and stdout, and prints the counters to stderr at the end
+
+Anything the Generator prints, e.g. about symbols which are not in
+the alphabet, goes to stderr so that it does not mix with the
+responses.
+"""
+    server = Server(generator, threads)
+    out_file = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    try:
+        if socket_path == "-":
+            server.serve_stream(sys.stdin.buffer, out_file)
+        else:
+            server.serve_socket(socket_path)
+    finally:
+        server.executor.shutdown()
+        sys.stdout = sys.__stdout__
+        server.report()
+    return
+
+
+class Client(object):
+    """A connection to a server started with twol-generate --serve
+
+    socket_path -- the Unix socket of the server
+
+    The methods send one request and wait for its response, so that
+    a Client can replace the module level functions of twgenerate in
+    programs such as word2entry.
+    """
+
+    def __init__(self, socket_path: str):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.sock_file = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def request(self, request: Dict) -> Dict:
+        """Sends a request and returns the response as a dict"""
+        self.next_id += 1
+        request = dict(request, id=self.next_id)
+        self.sock_file.write((json.dumps(request, ensure_ascii=False) +
+                              "\n").encode("utf-8"))
+        self.sock_file.flush()
+        line = self.sock_file.readline()
+        if not line:
+            raise ConnectionError("the server closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def generate_many(self, words: List[str]) -> List[List[str]]:
+        """Returns the surface forms of many morphophonemic words"""
+        return self.request({"op": "generate", "words": words})["results"]
+
+    def analyze_many(self, words: List[str]) -> List[List[str]]:
+        """Returns the morphophonemic forms of many surface words"""
+        return self.request({"op": "analyze", "words": words})["results"]
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the counters of the server"""
+        return self.request({"op": "stats"})["stats"]
+
+    def close(self) -> None:
+        self.sock_file.close()
+        self.sock.close()
+        return
@@ -0,0 +1,200 @@
+"""rulecache.py
+
+An on-disk cache for compiled two-level rules.  A compiled rule is
+stored as a file of three FSTs: the rule FST, the selector FST and
+the scrambler FST which are produced by the functions of the twrule
+module.
+
+The key of a rule is a digest of the normalized text of the rule, the
+texts of the definitions it uses (directly or through other
+definitions) and the pair alphabet of the examples.  Thus, a cached
+rule is reused only if none of these has changed.
+
+This is free software according to GNU GPL 3 license.
+"""
+
+import os
+
+import re
+
+import hashlib
+
+import hfst as hfst
+
+import twol.cfg as cfg
+
+cache_version = "1"
+"""Changing this invalidates all previously cached rules"""
+
+cache_dir = ""
+"""The directory where the rule FSTs are cached, empty if no caching"""
+
+definition_sources = {}
+"""The normalized text of each definition, indexed by the name"""
+
+alphabet_digest = ""
+
+def init(directory):
+    """Initializes the cache so that it uses the given directory
+
+    Assumes that the examples have already been read in.
+    """
+    global cache_dir, alphabet_digest
+    cache_dir = directory
+    os.makedirs(cache_dir, exist_ok=True)
+    alphabet_digest = cfg.pair_alphabet_digest()
+    return
+
+def normalize(rule_str):
+    """Returns the rule or definition with its white space normalized"""
+    return " ".join(rule_str.split())
+
+def add_definition(name, def_str):
+    """Records the text of a definition so that it can be part of keys"""
+    definition_sources[name] = normalize(def_str)
+    return
+
+def referenced_definitions(rule_str):
+    """Returns the set of names of definitions the rule depends on"""
+    name_set = set()
+    agenda = [rule_str]
+    while agenda:
+        text = agenda.pop()
+        for name in re.findall(r"[^\W_][^\W_]+", text):
+            if name in definition_sources and name not in name_set:
+                name_set.add(name)
+                agenda.append(definition_sources[name])
+    return name_set
+
+def rule_key(rule_str):
+    """Returns the cache key of a rule as a hex string"""
+    key_lst = [cache_version, alphabet_digest, normalize(rule_str)]
+    for name in sorted(referenced_definitions(rule_str)):
+        key_lst.append(definition_sources[name])
+    key_str = "\n".join(key_lst)
+    return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+def key_file_name(key):
+    return os.path.join(cache_dir, key + ".fst")
+
+def load(rule_str):
+    """Returns the cached rule FST, selector FST and scrambler FST
+
+    Returns None if the rule is not in the cache (or if there is no
+    cache).
+    """
+    if not cache_dir:
+        return None
+    file_name = key_file_name(rule_key(rule_str))
+    if not os.path.isfile(file_name):
+        return None
+    istream = hfst.HfstInputStream(file_name)
+    fst_lst = []
+    while not istream.is_eof():
+        fst_lst.append(istream.read())
+    istream.close()
+    if len(fst_lst) != 3:
+        return None
+    return tuple(fst_lst)
+
+def store(rule_str, rule_fst, selector_fst, scrambler_fst):
+    """Stores the FSTs of a compiled rule into the cache
+
+    The file is first written under a temporary name and then renamed
+    so that parallel processes never see partially written files.
+    """
+    if not cache_dir:
+        return
+    file_name = key_file_name(rule_key(rule_str))
+    temp_name = "{}.{}.tmp".format(file_name, os.getpid())
+    ostream = hfst.HfstOutputStream(filename=temp_name)
+    for fst in (rule_fst, selector_fst, scrambler_fst):
+        ostream.write(fst)
+    ostream.flush()
+    ostream.close()
+    os.replace(temp_name, file_name)
+    return
+
+changed_examples_fst = None
+"""In the incremental mode, an FST which accepts the examples that
+were added or removed since the previous run"""
+
+stored_verdict_dict = {}
+"""Test reports of the previous run, indexed by the rule key"""
+
+new_verdict_dict = {}
+"""Test reports of this run, indexed by the rule key"""
+
+def examples_state_file_name():
+    return os.path.join(cache_dir, "examples-state.json")
+
+def init_incremental(example_set):
+    """Prepares for retesting only the rules affected by changed examples
+
+    example_set -- the current set of examples as pair symbol strings
+
+    Compares example_set to the examples of the previous run and builds
+    changed_examples_fst out of the differences.  If there is no
+    previous run, all rules will be tested.
+
+    returns -- the number of added and removed examples or None if
+    there was no previous run
+    """
+    global changed_examples_fst, stored_verdict_dict
+    import json
+    import twol.twexamp as twexamp
+    file_name = examples_state_file_name()
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name, "r") as fil:
+        state = json.load(fil)
+    old_example_set = set(state["examples"])
+    changed_set = old_example_set ^ example_set
+    changed_examples_fst = twexamp.pairstrings_to_fst(changed_set)
+    stored_verdict_dict = state["verdicts"]
+    return len(changed_set)
+
+def save_incremental(example_set):
+    """Stores the examples and the test reports of this run"""
+    import json
+    file_name = examples_state_file_name()
+    temp_name = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(temp_name, "w") as fil:
+        json.dump({"examples": sorted(example_set),
+                   "verdicts": new_verdict_dict}, fil)
+    os.replace(temp_name, file_name)
+    return
+
+def is_affected(op, selector_fst, scrambler_fst):
+    """Tells whether the test results of a rule may have changed
+
+    A rule is affected if its selector or the input side of its
+    scrambler (which makes the negative examples) accepts some changed
+    example.  Rules with <-- are always affected because their negative
+    examples depend on the input sides of all examples.
+    """
+    if changed_examples_fst is None or op == "<--":
+        return True
+    relevant_fst = selector_fst.copy()
+    domain_fsa = scrambler_fst.copy()
+    domain_fsa.input_project()
+    relevant_fst.disjunct(hfst.fsa_to_fst(domain_fsa, separator="^"))
+    relevant_fst.intersect(changed_examples_fst)
+    relevant_fst.minimize()
+    return not relevant_fst.compare(hfst.empty_fst())
+
+def stored_verdict(rule_str, thorough):
+    """Returns the test report of the rule from the previous run or None"""
+    verdict = stored_verdict_dict.get(rule_key(rule_str))
+    if verdict and verdict["thorough"] == thorough:
+        return verdict["report"]
+    return None
+
+def record_verdict(rule_str, thorough, report):
+    """Records the test report of the rule in this run"""
+    new_verdict_dict[rule_key(rule_str)] = {"thorough": thorough,
+                                            "report": report}
+    return
+
+if __name__ == "__main__":
+    print("rulecache module is not meant to be used as a script")
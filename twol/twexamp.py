@@ -12,9 +12,12 @@ hfst.rules.restriction
 
 """
 import re
+import sys
+from array import array
 import hfst as hfst
 import twol.cfg as cfg
 import twol.twbt as twbt
+import twol.fs as fs
 
 def pairs_to_fst(pair_set):
     """Converts a seq of symbol pairs into a fst that accepts any of them
@@ -27,6 +30,172 @@ def pairs_to_fst(pair_set):
     fst.minimize()
     return fst
 
+half_pair_fst_cache = {}
+"""FSTs built by twparser.half_pair_fst() out of the indexes below,
+indexed by the symbol pair"""
+
+def index_pair_symbols():
+    """Builds the indexes cfg.insym2pairsym_set and cfg.outsym2pairsym_set
+
+    The indexes are built out of cfg.symbol_pair_set once the examples
+    have been read in.  The FSTs in half_pair_fst_cache were built out
+    of the previous indexes and they are discarded.
+    """
+    half_pair_fst_cache.clear()
+    for insym, outsym in cfg.symbol_pair_set:
+        pair_symbol = cfg.sympair2pairsym(insym, outsym)
+        cfg.insym2pairsym_set[insym].add(pair_symbol)
+        cfg.outsym2pairsym_set[outsym].add(pair_symbol)
+    return
+
+def minimal_pairs_fst(pairstr_lst):
+    """Builds a minimal FST out of sorted pair symbol strings
+
+    pairstr_lst -- examples as strings of space-separated pair symbols
+    in ascending order, duplicates allowed
+
+    The automaton is built incrementally according to Daciuk et al.
+    (2000), Incremental construction of minimal acyclic finite-state
+    automata.  When an example has been added, the states of the
+    previous example which are not on the path of the new one are final
+    and each of them is replaced by an equivalent state found in a
+    register, or else added to the register.  Thus, the automaton stays
+    minimal except for the path of the last example.  The examples are
+    handled as arrays of pair symbol ids, see cfg.pairsym_id().
+
+    Sorting the strings sorts the examples as sequences of pair symbols
+    because the space which separates the symbols is less than any
+    character in a symbol.
+    """
+    trans_lst = [{}]            # transitions of each state
+    final_lst = [False]
+    register = {}
+    prev_lst = array("I")
+    path_lst = [0]              # states along the previous example
+
+    def replace_or_register(length):
+        """Registers the states of the previous example beyond length"""
+        for k in range(len(prev_lst), length, -1):
+            state = path_lst[k]
+            signature = (final_lst[state],
+                         tuple(sorted(trans_lst[state].items())))
+            if signature in register:
+                trans_lst[path_lst[k - 1]][prev_lst[k - 1]] = \
+                    register[signature]
+                trans_lst[state] = None  # the state became unreachable
+            else:
+                register[signature] = state
+        del path_lst[length + 1:]
+
+    for pairstr in pairstr_lst:
+        id_lst = cfg.pairstr_to_ids(pairstr)
+        if id_lst == prev_lst and final_lst[path_lst[-1]]:
+            continue            # a duplicate, but not an initial empty one
+        prefix_len = 0
+        for pair_id, prev_id in zip(id_lst, prev_lst):
+            if pair_id != prev_id:
+                break
+            prefix_len += 1
+        replace_or_register(prefix_len)
+        state = path_lst[-1]
+        for pair_id in id_lst[prefix_len:]:
+            trans_lst.append({})
+            final_lst.append(False)
+            trans_lst[state][pair_id] = len(trans_lst) - 1
+            state = len(trans_lst) - 1
+            path_lst.append(state)
+        final_lst[state] = True
+        prev_lst = id_lst
+    replace_or_register(0)
+
+    bfst = hfst.HfstBasicTransducer()
+    number = {0: 0}             # state numbers in the HFST automaton
+    for state, trans in enumerate(trans_lst):
+        if trans is not None and state:
+            number[state] = bfst.add_state()
+    for state, trans in enumerate(trans_lst):
+        if trans is None:
+            continue
+        if final_lst[state]:
+            bfst.set_final_weight(number[state], 0.0)
+        for pair_id, target in trans.items():
+            insym, outsym = cfg.sympair_lst[pair_id]
+            bfst.add_transition(number[state],
+                                hfst.HfstBasicTransition(number[target],
+                                                         insym, outsym,
+                                                         0.0))
+    fst = hfst.HfstTransducer(bfst)
+    fst.minimize()
+    return fst
+
+def pairstrings_to_fst(pairstr_set):
+    """Converts pair symbol strings into a FST which accepts just them
+
+    pairstr_set -- a set of examples as space-separated strings of pair
+    symbols, e.g. as in cfg.example_set
+    """
+    return minimal_pairs_fst(sorted(pairstr_set))
+
+def build_shard(pairstr_lst):
+    """Builds the FST of one shard of examples in a worker process
+
+    Returns a tuple (fst_bytes, seconds, state_count).
+    """
+    import time
+    start = time.perf_counter()
+    fst = minimal_pairs_fst(pairstr_lst)
+    seconds = time.perf_counter() - start
+    return fs.fst_to_bytes(fst), seconds, fst.number_of_states()
+
+def sharded_pairs_fst(pairstr_set, shards, jobs=0):
+    """Builds the FST of the examples in shards in parallel
+
+    pairstr_set -- the examples as pair symbol strings
+
+    shards -- the number of shards into which the examples are split
+
+    jobs -- the number of worker processes, by default one per shard
+    but at most the number of processors
+
+    The sorted examples are split into consecutive shards of about equal
+    size and the minimal FST of each shard is built in a worker process.
+    With only one shard or at most one example, the FST is built
+    directly by minimal_pairs_fst().
+    The shard FSTs are then combined with fs.union_lst().  The time and
+    the number of states of each shard are reported if cfg.verbosity is
+    at least 1.
+    """
+    import os
+    import time
+    import multiprocessing
+    pairstr_lst = sorted(pairstr_set)
+    if shards <= 1 or len(pairstr_lst) <= 1:
+        return minimal_pairs_fst(pairstr_lst)
+    size = -(-len(pairstr_lst) // shards)
+    shard_lst = [pairstr_lst[i:i + size]
+                 for i in range(0, len(pairstr_lst), size)]
+    if not jobs:
+        jobs = min(len(shard_lst), os.cpu_count() or 1)
+    start = time.perf_counter()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=max(jobs, 1)) as pool:
+        result_lst = pool.map(build_shard, shard_lst)
+    fst_lst = []
+    for i, (fst_bytes, seconds, state_count) in enumerate(result_lst):
+        if cfg.verbosity >= 1:
+            print("shard {}: {} examples, {} states, {:.2f}s".format(
+                i + 1, len(shard_lst[i]), state_count, seconds))
+        fst_lst.append(fs.bytes_to_fst(fst_bytes))
+    merge_start = time.perf_counter()
+    fst = fs.union_lst(fst_lst)
+    if cfg.verbosity >= 1:
+        print("merged {} shards into {} states in {:.2f}s,"
+              " {:.2f}s in total".format(
+                  len(fst_lst), fst.number_of_states(),
+                  time.perf_counter() - merge_start,
+                  time.perf_counter() - start))
+    return fst
+
 def read_fst(filename="examples.fst"):
     """Reads in a previously stored example FST file
     """
@@ -44,26 +213,213 @@ def read_fst(filename="examples.fst"):
         cfg.symbol_pair_set.add((insym, outsym))
         cfg.input_symbol_set.add(insym)
         cfg.output_symbol_set.add(outsym)
+    index_pair_symbols()
     cfg.all_pairs_fst = pairs_to_fst(cfg.symbol_pair_set)
     if cfg.verbosity >= 30:
         twbt.ppfst(cfg.all_pairs_fst, title="cfg.all_pairs_fst")
     return
     
-def read_examples(filename_lst=["test.pstr"], build_fsts=True):
+example_cache_version = "2"
+"""Changed whenever the format of the example cache changes"""
+
+EXAMPLE_CACHE_MAGIC = b"TWOLEXAMPLES\n"
+"""The first bytes of an example cache file"""
+
+def source_stamp(file_name, old_stamp=None):
+    """Returns a dict which identifies the contents of a source file
+
+    The SHA-256 of the file is computed only if the size or the
+    modification time differs from the old stamp, otherwise it is
+    taken from there.
+    """
+    import os
+    import hashlib
+    stat = os.stat(file_name)
+    stamp = {"name": os.path.abspath(file_name),
+             "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if (old_stamp and old_stamp["size"] == stamp["size"] and
+        old_stamp["mtime"] == stamp["mtime"]):
+        stamp["sha256"] = old_stamp["sha256"]
+    else:
+        with open(file_name, "rb") as fil:
+            stamp["sha256"] = hashlib.sha256(fil.read()).hexdigest()
+    return stamp
+
+def example_cache_file(filename_lst):
+    """Returns the name of the example cache file for the sources or ''"""
+    import os
+    import hashlib
+    cache_dir = cfg.cache_directory()
+    if not cache_dir:
+        return ""
+    names = "\n".join(os.path.abspath(f) for f in filename_lst)
+    digest = hashlib.sha256(names.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "examples-{}.cache".format(digest[:16]))
+
+def load_example_cache(filename_lst):
+    """Returns the cached example state for the sources or None
+
+    The cache is valid only if the contents of all source files are the
+    same as when it was written.  A file whose modification time has
+    changed but whose contents are the same does not invalidate it.
+
+    The file is plain data, a JSON header followed by the arrays and
+    the FST, so reading it cannot execute anything.  The examples and
+    the FST are decoded here, and a file which cannot be read or decoded
+    for any reason is treated as if it did not exist.
+    """
+    import os
+    cache_file = example_cache_file(filename_lst)
+    if not (cache_file and os.path.isfile(cache_file)):
+        return None
+    try:
+        state = read_example_cache(cache_file)
+        if (state["version"] != example_cache_version or
+            len(state["sources"]) != len(filename_lst)):
+            return None
+        for name, old_stamp in zip(filename_lst, state["sources"]):
+            stamp = source_stamp(name, old_stamp)
+            if stamp["sha256"] != old_stamp["sha256"]:
+                return None
+        state["examples"] = cached_examples(state)
+        state["fst"] = (fs.bytes_to_fst(state["fst"])
+                        if state["fst"] else None)
+    except Exception:
+        return None
+    return state
+
+def read_example_cache(cache_file):
+    """Reads the header and the data of an example cache file into a dict
+
+    Raises an exception if the file is not a complete example cache.
+    """
+    import json
+    import struct
+    with open(cache_file, "rb") as fil:
+        data = fil.read()
+    if not data.startswith(EXAMPLE_CACHE_MAGIC):
+        raise ValueError("not an example cache file")
+    start = len(EXAMPLE_CACHE_MAGIC)
+    (header_len,) = struct.unpack_from("<I", data, start)
+    start += 4
+    state = json.loads(data[start:start + header_len].decode("utf-8"))
+    start += header_len
+    for name in ("ids", "lengths", "fst"):
+        size = state.pop(name + "_size")
+        if start + size > len(data):
+            raise ValueError("truncated example cache file")
+        state[name] = data[start:start + size]
+        start += size
+    return state
+
+def store_example_cache(filename_lst, invalid_lst, examples_fst=None):
+    """Writes the examples read from the sources into the example cache
+
+    Each distinct pair symbol is stored once and the examples are stored
+    as arrays of the indexes of their pair symbols.  The example FST is
+    stored, too, if it has been built.  The cache directory is created
+    so that only the user can access it.
+    """
+    import os
+    import json
+    import struct
+    from array import array
+    cache_file = example_cache_file(filename_lst)
+    if not cache_file:
+        return
+    symbol_lst = sorted(cfg.pair_symbol_set)
+    symbol_index = {sym: i for i, sym in enumerate(symbol_lst)}
+    ids = array("I")
+    lengths = array("I")
+    for example in cfg.example_lst:
+        pairsym_lst = example.split()
+        ids.extend(symbol_index[pairsym] for pairsym in pairsym_lst)
+        lengths.append(len(pairsym_lst))
+    fst_bytes = (fs.fst_to_bytes(examples_fst)
+                 if examples_fst is not None else b"")
+    ids_bytes = ids.tobytes()
+    lengths_bytes = lengths.tobytes()
+    header = json.dumps(
+        {"version": example_cache_version,
+         "sources": [source_stamp(name) for name in filename_lst],
+         "symbols": symbol_lst,
+         "invalid": invalid_lst,
+         "ids_size": len(ids_bytes),
+         "lengths_size": len(lengths_bytes),
+         "fst_size": len(fst_bytes)},
+        ensure_ascii=False).encode("utf-8")
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        temp_name = "{}.{}.tmp".format(cache_file, os.getpid())
+        with open(temp_name, "wb") as fil:
+            fil.write(EXAMPLE_CACHE_MAGIC)
+            fil.write(struct.pack("<I", len(header)))
+            fil.write(header)
+            fil.write(ids_bytes)
+            fil.write(lengths_bytes)
+            fil.write(fst_bytes)
+        os.replace(temp_name, cache_file)
+    except OSError:
+        pass
+    return
+
+def cached_examples(state):
+    """Returns the list of examples out of a cached example state"""
+    from array import array
+    symbol_lst = state["symbols"]
+    ids = array("I")
+    ids.frombytes(state["ids"])
+    lengths = array("I")
+    lengths.frombytes(state["lengths"])
+    example_lst = []
+    start = 0
+    for length in lengths:
+        example_lst.append(" ".join(symbol_lst[i]
+                                    for i in ids[start:start + length]))
+        start += length
+    if start != len(ids):
+        raise ValueError("inconsistent example cache")
+    return example_lst
+
+def read_examples(filename_lst=["test.pstr"], build_fsts=True, shards=1):
     """Reads the examples from files whose names are 'filename_lst'.
     
     The file must contain one example per line and each line consists of
     a space separated sequence of pair-symbols.
     The examples are processed to a FST which is a union of all examples.
+    It is built by minimal_pairs_fst() out of the sorted examples, so
+    that no large unminimized automaton is needed.
+
+    If shards is more than 1, the FST is built in so many parts in
+    parallel by sharded_pairs_fst().
+
+    The examples and their FST are stored in an example cache in
+    cfg.cache_directory() which all programs share.  Next time, they
+    are read from there unless the contents of some file has changed.
     """
     import os
     import fileinput
     for f in filename_lst:
         if not os.path.isfile(f):
             exit("EXAMPLE FILE {} DOES NOT EXIST".format(f))
-    if build_fsts:
-        examples_bfst = hfst.HfstBasicTransducer()
-    for line_nl in fileinput.input(filename_lst):
+    state = load_example_cache(filename_lst)
+    if state:
+        if cfg.verbosity >= 10:
+            print("examples read from the example cache", file=sys.stderr)
+        for line in state["invalid"]:
+            print("*** example contains an invalid pair symbol")
+            print(line)
+        for pair_symbol_str in state["examples"]:
+            cfg.example_lst.append(pair_symbol_str)
+            cfg.example_set.add(pair_symbol_str)
+        for pairsym in state["symbols"]:
+            cfg.symbol_pair_set.add(cfg.pairsym2sympair(pairsym))
+        invalid_lst = state["invalid"]
+        line_nl_seq = []
+    else:
+        invalid_lst = []
+        line_nl_seq = fileinput.input(filename_lst)
+    for line_nl in line_nl_seq:
         line = line_nl.strip()
         if not line or line.startswith("!"):
             continue
@@ -75,6 +431,7 @@ def read_examples(filename_lst=["test.pstr"], build_fsts=True):
         if not all([insym and outsym for insym, outsym in symbol_pair_lst]):
             print("*** example contains an invalid pair symbol")
             print(line)
+            invalid_lst.append(line)
             continue
         if cfg.verbosity >= 30:
             print("symbol_pair_lst:", symbol_pair_lst)
@@ -85,10 +442,6 @@ def read_examples(filename_lst=["test.pstr"], build_fsts=True):
             print("pair_symbol_str:", pair_symbol_str)
         cfg.example_lst.append(pair_symbol_str)
         cfg.example_set.add(pair_symbol_str) # spaces normalized
-        #LINE_FST = hfst.tokenized_fst(symbol_pair_lst)
-        # twbt.printfst(LINE_FST, True) ##
-        if build_fsts:
-            examples_bfst.disjunct(symbol_pair_lst, 0)
         for insym, outsym in symbol_pair_lst:
             cfg.symbol_pair_set.add((insym, outsym))
 
@@ -97,9 +450,13 @@ def read_examples(filename_lst=["test.pstr"], build_fsts=True):
         print("List of alphabet symbol pairs:", sorted(cfg.symbol_pair_set))
     if build_fsts:
         cfg.all_pairs_fst = pairs_to_fst(cfg.symbol_pair_set)
-        cfg.examples_fst = hfst.HfstTransducer(examples_bfst)
+        if state and state["fst"] is not None:
+            cfg.examples_fst = state["fst"]
+        elif shards > 1:
+            cfg.examples_fst = sharded_pairs_fst(cfg.example_set, shards)
+        else:
+            cfg.examples_fst = pairstrings_to_fst(cfg.example_set)
         cfg.examples_fst.set_name(filename_lst[-1])
-        cfg.examples_fst.minimize()
         if cfg.verbosity >= 30:
             twbt.ppfst(cfg.examples_fst, False, title="Example file as FST")
     for insym, outsym in cfg.symbol_pair_set:
@@ -108,12 +465,16 @@ def read_examples(filename_lst=["test.pstr"], build_fsts=True):
     for insym, outsym in cfg.symbol_pair_set:
         pair_symbol = cfg.sympair2pairsym(insym, outsym)
         cfg.pair_symbol_set.add(pair_symbol)
+    index_pair_symbols()
     if build_fsts:
         pair_symbol_lst = [insym+':'+outsym for insym, outsym
                            in cfg.symbol_pair_set]
         pair_symbol_str = " ".join(sorted(pair_symbol_lst))
         # print("symbol pairs:", pair_symbol_str) ##
         cfg.examples_fst.set_property("x-pair_symbols", pair_symbol_str)
+    if not state or (build_fsts and state["fst"] is None):
+        store_example_cache(filename_lst, invalid_lst,
+                            cfg.examples_fst if build_fsts else None)
     return
 
 def main():
@@ -142,6 +503,11 @@ def main():
         "-o", "--output",
         help="file to which write the example FST",
         default="")
+    arpar.add_argument(
+        "-s", "--shards",
+        help="number of parts in which the example FST is built"\
+        " in parallel, useful for very large sets of examples",
+        type=int, default=1)
     arpar.add_argument(
         "-v", "--verbosity",
         help="level of  diagnostic output",
@@ -150,7 +516,7 @@ def main():
     
     cfg.verbosity = args.verbosity
     
-    read_examples(args.input, build_fsts=True)
+    read_examples(args.input, build_fsts=True, shards=args.shards)
     
     if args.output:
         exfile = hfst.HfstOutputStream(filename=args.output)
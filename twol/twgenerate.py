@@ -4,8 +4,16 @@ Generates surface forms out of morphophonemic representations
 according to previously compiled two-level rule FST.  The FST is first
 converted into a tuple of a Python dict and a Python set of final
 states.  The outer dict is indexed by the state numbers, giving
-transition dicts.  A transition dict is indexed by symbol pairs and
-gives the next state.  These Python structures are then used for generating the surface form (possibly containing some zeros).
+transition dicts.  A transition dict is indexed by the ids of symbol
+pairs (see cfg.sympair_id()) and gives the next state.  When all rules
+have been read, the dicts are packed into flat integer arrays, one for
+each rule, which are then used for generating the surface form
+(possibly containing some zeros).  The same tables are used for
+analyzing surface forms into morphophonemic representations.
+
+The tables of one grammar are owned by a Generator object.  The
+module level functions init(), generate() etc. use a default
+Generator.
 
 Copyright 2017-2025, Kimmo Koskenniemi
 
@@ -13,12 +21,24 @@ This is free software according to GNU GPL 3 license.
 
 """
 
-from typing import List, Dict, Set, Tuple, NewType
+from typing import List, Dict, Set, Tuple, NewType, Iterator, Optional, Union
 
 import re
 
+import threading
+
+from array import array
+
+from collections import OrderedDict
+
+from functools import partial
+
+import grapheme
+
 import hfst as hfst
 
+import twol.cfg as cfg
+
 PairSym = str
 InSym = str # one mophophonemic symbol as a string
 OutSym = str # ine surface symbol as a string
@@ -31,137 +51,1264 @@ FST = NewType("FST", hfst.libhfst.HfstTransducer)
 # <class 'hfst.libhfst.HfstTransducer'>
 # <class 'hfst.libhfst.HfstInputStream'>
 
-input_alphabet: Set[InSym] = set()
-pairs_with_insym: dict[InSym,
-                       set[tuple[InSym, OutSym]]] = {}
+PairId = int # a pair symbol interned by cfg.sympair_id()
 
-RuleTransition = dict[SymPair, State]
-"""These are accessed as RuleDict[current_state] and they give the individual transitions from that current_state with SymPair a new_state.
+ZERO: OutSym = "Ø"
+"""The OutSym of the pairs which have no surface counterpart"""
+
+RuleTransition = dict[PairId, State]
+"""These are accessed as RuleDict[current_state] and they give the individual transitions from that current_state with the id of a SymPair to a new_state.
 """
 
 RuleDict = dict[State, RuleTransition]
 # A HFST transducer converted into a Python Dict
 
-rule_dict_lst: List[RuleDict] = []
+NO_STATE = -1
+"""The entry in a rule table for a missing transition"""
+
+RuleTable = array
+"""A rule as a flat array('i') (or a memoryview of ints, see
+Generator.load_tables()) of pair_count entries for each state.
+A state is represented by the offset of its row, i.e. its number
+times pair_count, and the entry at the offset plus a pair id is the
+offset of the next state or NO_STATE."""
+
+StateTuple = Tuple[State, ...] # the current state offsets of all rules
+
+ProductState = int # the id of a StateTuple in the product automaton
+
+Lookahead = Tuple[int, int] # bitmasks of the allowed and the required InSyms
+
+NO_LOOKAHEAD: Lookahead = (-1, 0)
+"""The Lookahead which prunes nothing"""
+
+DEAD_LOOKAHEAD: Lookahead = (0, -1)
+"""The Lookahead of a state from which no final state can be reached"""
+
+TABLE_MAGIC = b"TWOLGEN\x01"
+"""The first bytes of a file written by Generator.export_tables()"""
+
+
+def table_rule(rule_dict: RuleDict, final_states: Set[State],
+               pair_count: int) -> tuple[RuleTable, Set[State]]:
+    """Packs a RuleDict into a RuleTable
+
+:param rule_dict: A rule as returned by Generator.dict_rule()
+:param final_states: The final states as returned by Generator.dict_rule()
+:param pair_count: The length of a row of the table
+:return: A tuple of the RuleTable and the set of the offsets of the final states
+"""
+    state_count = max(rule_dict) + 1 if rule_dict else 1
+    table = array("i", [NO_STATE]) * (state_count * pair_count)
+    for state, trans_dict in rule_dict.items():
+        row = state * pair_count
+        for pair_id, target in trans_dict.items():
+            table[row + pair_id] = target * pair_count
+    return table, {state * pair_count for state in final_states}
+
+
+def is_table_file(file_name: str) -> bool:
+    """Tells whether a file was written by Generator.export_tables()"""
+    with open(file_name, "rb") as fil:
+        return fil.read(len(TABLE_MAGIC)) == TABLE_MAGIC
+
+
+def remap_table(table, file_pair_count: int, id_lst: List[PairId],
+                pair_count: int):
+    """Converts a RuleTable of a file to the current pair ids"""
+    import sys
+    if sys.byteorder != "little":
+        table = array("i", table)
+        table.byteswap()
+    state_count = len(table) // file_pair_count if file_pair_count else 0
+    new_table = array("i", [NO_STATE]) * (state_count * pair_count)
+    for state in range(state_count):
+        for i, pair_id in enumerate(id_lst):
+            target = table[state * file_pair_count + i]
+            if target != NO_STATE:
+                new_table[state * pair_count + pair_id] = \
+                    target // file_pair_count * pair_count
+    return new_table
+
+
+class ProductAutomaton(object):
+    """The part of the product automaton of the rules built so far
 
-finality_dict_lst: List[set[State]] = []
+    Product states are numbered in the order in which they are reached.
+    A search uses the same ProductAutomaton from its beginning to its
+    end, because the numbers are valid only there.
+    """
 
+    def __init__(self):
+        self.id_dict: Dict[StateTuple, ProductState] = {}
+        """The ids of the StateTuples which have been reached"""
+        self.tpl_lst: List[StateTuple] = []
+        """The StateTuple of each product state"""
+        self.final_lst: List[bool] = []
+        """Whether each product state is final"""
+        self.trans_cache: "OrderedDict[tuple, list]" = OrderedDict()
+        """The transitions of product states for an InSym, or for an
+        OutSym when analyzing, as lists of (PairId, ProductState,
+        Lookahead) in the least recently used order.  The keys are
+        (ProductState, InSym) and (ProductState, ZERO, OutSym),
+        respectively."""
 
-def dict_rule(rule_fst: FST
-              ) -> tuple[RuleDict,
-                         Set[State]]:
-    """Converts one HFST rule transducer into a pair of RuleDict and set of its final states. 
+
+class Generator(object):
+    """The rule tables of one grammar and the searches which use them
+
+    rule_file_name -- if given, the rules are read with load()
+
+    use_product -- if True, the searches run on the lazily built
+    product automaton of the rules instead of advancing each rule
+    separately
+
+    product_cache_size -- the maximum number of cached transition
+    lists of the product automaton, and the maximum number of its
+    states after which it is started anew
+
+    max_zeros -- the maximum number of zeros which analysis_search()
+    inserts into a surface word
+
+    use_lookahead -- if True, load() computes the Lookaheads of the
+    rules and the searches prune branches with them, see
+    compute_lookahead().  This pays off only with rules whose states
+    restrict the rest of the word a lot, otherwise it slows the
+    searches down.
+
+    result_cache_size -- if not zero, generate() and generate_many()
+    keep the surface forms of at most this many recently generated
+    words, see cached_result()
+
+    The tables are not changed by the searches, and each search keeps
+    its own state in local variables.  The only shared state which the
+    searches change is the product automaton and it is guarded by a
+    lock.  Thus, once the rules have been loaded, one Generator can be
+    used from several threads at the same time, and two Generators can
+    have different grammars in the same process.  The rules should not
+    be loaded again while other threads are using the Generator.
+    The result cache is guarded by a lock of its own.
+    """
+
+    def __init__(self, rule_file_name: Optional[str] = None,
+                 use_product: bool = False,
+                 product_cache_size: int = 100000,
+                 max_zeros: int = 1,
+                 use_lookahead: bool = False,
+                 result_cache_size: int = 0):
+        self.use_product = use_product
+        self.product_cache_size = product_cache_size
+        self.max_zeros = max_zeros
+        self.use_lookahead = use_lookahead
+        self.result_cache_size = result_cache_size
+        self.product_lock = threading.Lock()
+        self.result_lock = threading.Lock()
+        self.clear_tables()
+        if rule_file_name:
+            self.load(rule_file_name)
+
+    def clear_tables(self) -> None:
+        """Forgets the rules"""
+        self.input_alphabet: Set[InSym] = set()
+        self.pairs_with_insym: Dict[InSym, Set[PairId]] = {}
+        self.output_alphabet: Set[OutSym] = set()
+        self.pairs_with_outsym: Dict[OutSym, Set[PairId]] = {}
+        """The pairs of each OutSym, for analyzing surface forms"""
+        self.pair_count: int = 0
+        """The number of pair ids, i.e. the length of a row in a rule
+        table"""
+        self.rule_table_lst: List[RuleTable] = []
+        self.finality_dict_lst: List[Set[State]] = []
+        """For each rule, the set of the offsets of its final states"""
+        self.table_mmap = None
+        """The memory map of the file read by load_tables()"""
+        self.insym_bit_dict: Dict[InSym, int] = {}
+        """The bit of each InSym in the masks of Lookaheads"""
+        self.lookahead_lst: List[Tuple[int, Dict[State, Lookahead]]] = []
+        """The Lookaheads of those rules which can prune something,
+        see compute_lookahead()"""
+        self.clear_product()
+        self.clear_results()
+        return
+
+    def dict_rule(self, rule_fst: FST
+                  ) -> tuple[RuleDict,
+                             Set[State]]:
+        """Converts one HFST rule transducer into a pair of RuleDict and set of its final states.
 
 :param rule_fst:  A rule transducer in HfstTransducer form
 :return: A tuple with two components, a RuleDict equivalent to the rule_fst, and a set of final states in the transducer
 """
-    global rule_dict_lst
-    brule = hfst.HfstBasicTransducer(rule_fst)
-    rule_dict = {}
-    final_states: Set[State] = set()
-    for state in brule.states():
-        if brule.is_final_state(state):
-            final_states.add(state)
-        trans_dict: dict[tuple[InSym, OutSym], State] = {}
-        for transition in brule.transitions(state):
-            insym = InSym(transition.get_input_symbol())
-            if not insym in input_alphabet:
-                input_alphabet.add(insym)
-            outsym = OutSym(transition.get_output_symbol())
-            target = transition.get_target_state()
-            trans_dict[(insym,outsym)] = State(target)
-            if insym not in pairs_with_insym:
-                pairs_with_insym[insym] = set()
-            pairs_with_insym[insym].add((insym, outsym))
-        rule_dict[state] = trans_dict
-    return rule_dict, final_states
+        brule = hfst.HfstBasicTransducer(rule_fst)
+        rule_dict = {}
+        final_states: Set[State] = set()
+        for state in brule.states():
+            if brule.is_final_state(state):
+                final_states.add(state)
+            trans_dict: dict[PairId, State] = {}
+            for transition in brule.transitions(state):
+                insym = InSym(transition.get_input_symbol())
+                if not insym in self.input_alphabet:
+                    self.input_alphabet.add(insym)
+                outsym = OutSym(transition.get_output_symbol())
+                target = transition.get_target_state()
+                pair_id = cfg.sympair_id(insym, outsym)
+                trans_dict[pair_id] = State(target)
+                if insym not in self.pairs_with_insym:
+                    self.pairs_with_insym[insym] = set()
+                self.pairs_with_insym[insym].add(pair_id)
+                self.output_alphabet.add(outsym)
+                self.pairs_with_outsym.setdefault(outsym, set()).add(pair_id)
+            rule_dict[state] = trans_dict
+        return rule_dict, final_states
 
+    def load(self, rule_file_name: str) -> None:
+        """Reads the rules and converts them into RuleTables
 
-def init(rule_file_name: str) -> None:
-    global rule_dict_lst
-    istream = hfst.HfstInputStream(rule_file_name)
-    while not (istream.is_eof()):
-        fst = FST(istream.read())
-        rule_d, final_states = dict_rule(fst)
-        rule_dict_lst.append(RuleDict(rule_d))
-        finality_dict_lst.append(final_states)
-    istream.close()
-    return
+:param rule_file_name: Either a file of HFST rule transducers or a file written by export_tables()
+
+Any rules read before are forgotten.
+"""
+        self.clear_tables()
+        if is_table_file(rule_file_name):
+            self.load_tables(rule_file_name)
+            return
+        rule_lst = []
+        istream = hfst.HfstInputStream(rule_file_name)
+        while not (istream.is_eof()):
+            fst = FST(istream.read())
+            rule_lst.append(self.dict_rule(fst))
+        istream.close()
+        self.pair_count = len(cfg.sympair_lst)
+        for rule_d, final_states in rule_lst:
+            table, final_offsets = table_rule(rule_d, final_states,
+                                              self.pair_count)
+            self.rule_table_lst.append(table)
+            self.finality_dict_lst.append(final_offsets)
+        self.compute_lookahead()
+        return
+
+    def export_tables(self, file_name: str) -> None:
+        """Writes the rule tables into a file which load_tables() can map
 
-result_lst: list[OutSymWord] = []
+The file consists of TABLE_MAGIC, the length of a JSON header as a
+4-byte little-endian int, the header which gives the symbol pairs and
+the final states of each rule, padding to a multiple of 4 bytes and
+the RuleTables of the rules as 4-byte little-endian ints.
+"""
+        import json
+        import struct
+        import sys
+        pair_count = self.pair_count
+        pairs = [list(cfg.sympair_lst[i]) for i in range(pair_count)]
+        used = sorted(pair_id for pair_set in self.pairs_with_insym.values()
+                      for pair_id in pair_set)
+        rules = [{"states": len(table) // pair_count if pair_count else 0,
+                  "finals": sorted(offset // pair_count
+                                   for offset in finality)}
+                 for table, finality in zip(self.rule_table_lst,
+                                            self.finality_dict_lst)]
+        header = json.dumps({"pairs": pairs, "used": used, "rules": rules},
+                            ensure_ascii=False).encode("utf-8")
+        with open(file_name, "wb") as fil:
+            fil.write(TABLE_MAGIC)
+            fil.write(struct.pack("<I", len(header)))
+            fil.write(header)
+            fil.write(b"\0" * (-(len(TABLE_MAGIC) + 4 + len(header)) % 4))
+            for table in self.rule_table_lst:
+                if sys.byteorder != "little":
+                    table = array("i", table)
+                    table.byteswap()
+                fil.write(table.tobytes() if isinstance(table, array)
+                          else bytes(table))
+        return
 
+    def load_tables(self, file_name: str) -> None:
+        """Maps the rule tables of a file written by export_tables()
 
-def path_search(state_lst: List[State],
-                insym_lst: List[InSym],
-                outsym_lst: List[OutSym]):
-    """Advance incrementally in a dict transducer and 
+The RuleTables are memoryviews of the mapped file, so that they are
+not copied and several processes share the same pages.  If the pair
+ids of cfg do not match those of the file, e.g. because some pairs
+were interned before, or if the machine is big-endian, the tables are
+copied and converted instead.
+"""
+        import json
+        import mmap
+        import struct
+        import sys
+        with open(file_name, "rb") as fil:
+            self.table_mmap = mmap.mmap(fil.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+        table_mmap = self.table_mmap
+        start = len(TABLE_MAGIC)
+        (header_len,) = struct.unpack_from("<I", table_mmap, start)
+        start += 4
+        header = json.loads(bytes(table_mmap[start:start + header_len]))
+        start += header_len
+        start += -start % 4
+        id_lst = [cfg.sympair_id(insym, outsym)
+                  for insym, outsym in header["pairs"]]
+        for i in header["used"]:
+            insym, outsym = header["pairs"][i]
+            self.input_alphabet.add(insym)
+            self.pairs_with_insym.setdefault(insym, set()).add(id_lst[i])
+            self.output_alphabet.add(outsym)
+            self.pairs_with_outsym.setdefault(outsym, set()).add(id_lst[i])
+        file_pair_count = len(id_lst)
+        same_ids = (id_lst == list(range(file_pair_count)) and
+                    sys.byteorder == "little")
+        pair_count = file_pair_count if same_ids else len(cfg.sympair_lst)
+        self.pair_count = pair_count
+        view = memoryview(table_mmap)
+        for rule in header["rules"]:
+            size = rule["states"] * file_pair_count
+            table = view[start:start + 4 * size].cast("i")
+            start += 4 * size
+            if not same_ids:
+                table = remap_table(table, file_pair_count, id_lst,
+                                    pair_count)
+            self.rule_table_lst.append(table)
+            self.finality_dict_lst.append({state * pair_count
+                                           for state in rule["finals"]})
+        self.compute_lookahead()
+        return
 
-:state_lst: List of states from which suitable transitions might start from
-:param insym_lst: List of remaining InSyms of the word to be generated
+    def advance(self, state_tpl: StateTuple,
+                pair_id: PairId) -> Optional[StateTuple]:
+        """Advances all rules with one symbol pair
 
+:param state_tpl: The current states of the rules
+:param pair_id: The id of the symbol pair
+:return: The new states or None if some rule has no transition
 """
-    global result_lst, rule_dict_lst
-    
-    if not insym_lst:
-        for state, finality in zip(state_lst, finality_dict_lst):
+        new_state_lst = []
+        for state, table in zip(state_tpl, self.rule_table_lst):
+            target = table[state + pair_id]
+            if target == NO_STATE:
+                return None
+            new_state_lst.append(target)
+        return tuple(new_state_lst)
+
+    def is_final(self, state_tpl: StateTuple) -> bool:
+        """Tells whether all rules are in a final state"""
+        for state, finality in zip(state_tpl, self.finality_dict_lst):
             if state not in finality:
+                return False
+        return True
+
+    def compute_lookahead(self) -> None:
+        """Computes lookahead_lst out of the RuleTables
+
+The lookahead_lst consists of pairs of the index of a rule and a dict
+from state offsets to Lookaheads.  The allowed mask of a state tells
+which InSyms occur on some path from the state to a final state, and
+the required mask which InSyms occur on all such paths.  The masks
+are computed backwards from the final states until they do not change
+any more.  States from which no final state can be reached are left
+out of the dicts and get the DEAD_LOOKAHEAD.  Rules where no state
+restricts the rest of the word are left out altogether.
+
+Only the bits of the InSyms are computed if use_lookahead is False,
+and then lookahead_lst stays empty and nothing is pruned.
+"""
+        pair_count = self.pair_count
+        self.lookahead_lst.clear()
+        self.insym_bit_dict.clear()
+        for insym in self.input_alphabet:
+            self.insym_bit_dict[insym] = 1 << cfg.insym_id(insym)
+        if not self.use_lookahead:
+            return
+        pair_bit_lst = [1 << cfg.pair_insym_ids[pair_id]
+                        for pair_id in range(pair_count)]
+        all_insyms = 0
+        for bit in pair_bit_lst:
+            all_insyms |= bit
+        for rule_index, (table, finality) in enumerate(
+                zip(self.rule_table_lst, self.finality_dict_lst)):
+            state_count = len(table) // pair_count if pair_count else 0
+            arc_lst = []        # (state offset, bit, target offset)
+            for row in range(0, state_count * pair_count, pair_count):
+                for pair_id in range(pair_count):
+                    target = table[row + pair_id]
+                    if target != NO_STATE:
+                        arc_lst.append((row, pair_bit_lst[pair_id], target))
+            allowed_dict: Dict[State, int] = {offset: 0
+                                              for offset in finality}
+            required_dict: Dict[State, int] = {offset: 0
+                                               for offset in finality}
+            changed = True
+            while changed:
+                changed = False
+                for row, bit, target in arc_lst:
+                    if target not in allowed_dict:
+                        continue
+                    allowed = (allowed_dict.get(row, 0) | bit |
+                               allowed_dict[target])
+                    required = (required_dict.get(row, -1) &
+                                (bit | required_dict[target]))
+                    if (allowed != allowed_dict.get(row) or
+                        required != required_dict[row]):
+                        allowed_dict[row] = allowed
+                        required_dict[row] = required
+                        changed = True
+            mask_dict = {row: (allowed_dict[row], required_dict[row])
+                         for row in allowed_dict}
+            if (len(mask_dict) < state_count or
+                any(mask != (all_insyms, 0) for mask in mask_dict.values())):
+                self.lookahead_lst.append((rule_index, mask_dict))
+        return
+
+    def lookahead(self, state_tpl: StateTuple) -> Lookahead:
+        """Returns the Lookahead of all rules in state_tpl
+
+A branch can be pruned if the rest of the word has an InSym which is
+not in the allowed mask or lacks an InSym which is in the required
+mask.
+"""
+        allowed, required = NO_LOOKAHEAD
+        dead = DEAD_LOOKAHEAD
+        for rule_index, mask_dict in self.lookahead_lst:
+            rule_allowed, rule_required = mask_dict.get(state_tpl[rule_index],
+                                                        dead)
+            allowed &= rule_allowed
+            required |= rule_required
+        return allowed, required
+
+    def suffix_masks(self, insym_lst: List[InSym]) -> List[int]:
+        """Returns for each position the bitmask of the InSyms from there on"""
+        insym_bit_dict = self.insym_bit_dict
+        mask_lst = [0] * (len(insym_lst) + 1)
+        for pos in range(len(insym_lst) - 1, -1, -1):
+            mask_lst[pos] = mask_lst[pos + 1] | insym_bit_dict[insym_lst[pos]]
+        return mask_lst
+
+    def pair_successors(self, state_tpl: StateTuple, pair_ids: Set[PairId]
+                        ) -> Iterator[Tuple[PairId, StateTuple, Lookahead]]:
+        """Yields the pairs of pair_ids which all rules accept in state_tpl,
+together with the resulting states and their Lookaheads"""
+        rule_table_lst = self.rule_table_lst
+        lookahead = self.lookahead if self.lookahead_lst else None
+        for pair_id in pair_ids:
+            # advance() inlined, this is the innermost loop of the searches
+            new_state_lst = []
+            for state, table in zip(state_tpl, rule_table_lst):
+                target = table[state + pair_id]
+                if target == NO_STATE:
+                    break
+                new_state_lst.append(target)
+            else:
+                new_state_tpl = tuple(new_state_lst)
+                yield (pair_id, new_state_tpl,
+                       lookahead(new_state_tpl) if lookahead
+                       else NO_LOOKAHEAD)
+
+    def tuple_successors(self, state_tpl: StateTuple, insym: InSym
+                         ) -> Iterator[Tuple[PairId, StateTuple, Lookahead]]:
+        """Yields the successors of state_tpl with the pairs of insym"""
+        return self.pair_successors(state_tpl, self.pairs_with_insym[insym])
+
+    def tuple_out_successors(self, state_tpl: StateTuple, outsym: OutSym
+                             ) -> Iterator[Tuple[PairId, StateTuple,
+                                                 Lookahead]]:
+        """Yields the successors of state_tpl with the pairs of outsym"""
+        return self.pair_successors(state_tpl,
+                                    self.pairs_with_outsym.get(outsym, set()))
+
+    def clear_product(self) -> None:
+        """Forgets the product automaton, e.g. when the rules change"""
+        with self.product_lock:
+            self.product = ProductAutomaton()
+            """The ProductAutomaton which new searches use"""
+            self.product_stats: Dict[str, int] = {"hits": 0, "misses": 0,
+                                                  "evictions": 0,
+                                                  "resets": 0}
+        return
+
+    def product_state(self, product: ProductAutomaton,
+                      state_tpl: StateTuple) -> ProductState:
+        """Returns the id of a StateTuple in the product automaton
+
+The caller must hold product_lock.
+"""
+        if state_tpl not in product.id_dict:
+            product.id_dict[state_tpl] = len(product.tpl_lst)
+            product.tpl_lst.append(state_tpl)
+            product.final_lst.append(self.is_final(state_tpl))
+        return product.id_dict[state_tpl]
+
+    def product_successors(self, product: ProductAutomaton,
+                           state: ProductState, insym: InSym
+                           ) -> List[Tuple[PairId, ProductState, Lookahead]]:
+        """Returns the transitions of a product state with the pairs of insym
+
+The transitions are computed on first use and kept in a cache of at
+most product_cache_size entries from which the least recently used
+ones are dropped.
+"""
+        return self.product_transitions(product, (state, insym),
+                                        self.pairs_with_insym[insym])
+
+    def product_out_successors(self, product: ProductAutomaton,
+                               state: ProductState, outsym: OutSym
+                               ) -> List[Tuple[PairId, ProductState,
+                                               Lookahead]]:
+        """Returns the transitions of a product state with the pairs of outsym"""
+        return self.product_transitions(product, (state, ZERO, outsym),
+                                        self.pairs_with_outsym.get(outsym,
+                                                                   set()))
+
+    def product_transitions(self, product: ProductAutomaton, key: tuple,
+                            pair_ids: Set[PairId]
+                            ) -> List[Tuple[PairId, ProductState, Lookahead]]:
+        """Returns the transitions of the product state key[0] with the
+pairs of pair_ids, from the transition cache if they are there
+
+When the product automaton has more than product_cache_size states,
+new searches get a new, empty ProductAutomaton, so that the states do
+not pile up in a long-running process.  The searches which are using
+the old one go on with it and it is freed when they have finished.
+"""
+        with self.product_lock:
+            trans_cache = product.trans_cache
+            trans_lst = trans_cache.get(key)
+            if trans_lst is not None:
+                self.product_stats["hits"] += 1
+                trans_cache.move_to_end(key)
+                return trans_lst
+            self.product_stats["misses"] += 1
+            trans_lst = [(pair_id, self.product_state(product, new_state_tpl),
+                          look)
+                         for pair_id, new_state_tpl, look
+                         in self.pair_successors(product.tpl_lst[key[0]],
+                                                 pair_ids)]
+            trans_cache[key] = trans_lst
+            if len(trans_cache) > self.product_cache_size:
+                trans_cache.popitem(last=False)
+                self.product_stats["evictions"] += 1
+            if (product is self.product and
+                len(product.tpl_lst) > self.product_cache_size):
+                self.product = ProductAutomaton()
+                self.product_stats["resets"] += 1
+        return trans_lst
+
+    def clear_results(self) -> None:
+        """Empties the result cache, e.g. when the rules change"""
+        with self.result_lock:
+            self.result_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+            """The surface forms of the most recently generated words,
+            indexed by the tuples of their InSyms, in the least recently
+            used order"""
+            self.result_stats: Dict[str, int] = {"hits": 0, "misses": 0,
+                                                 "evictions": 0}
+        return
+
+    def cached_result(self, key: Tuple[InSym, ...]
+                      ) -> Optional[Tuple[OutSymWord, ...]]:
+        """Returns the cached surface forms of a tokenized word or None"""
+        with self.result_lock:
+            result = self.result_cache.get(key)
+            if result is None:
+                self.result_stats["misses"] += 1
+            else:
+                self.result_stats["hits"] += 1
+                self.result_cache.move_to_end(key)
+        return result
+
+    def cache_result(self, key: Tuple[InSym, ...],
+                     result: List[OutSymWord]) -> None:
+        """Stores the surface forms of a tokenized word in the cache and
+drops the least recently used entry if the cache is full"""
+        with self.result_lock:
+            self.result_cache[key] = tuple(result)
+            self.result_cache.move_to_end(key)
+            if len(self.result_cache) > self.result_cache_size:
+                self.result_cache.popitem(last=False)
+                self.result_stats["evictions"] += 1
+        return
+
+    def result_cache_info(self) -> Dict[str, Union[int, float]]:
+        """Returns the size, the counters and the hit rate of the result
+cache"""
+        with self.result_lock:
+            info: Dict[str, Union[int, float]] = dict(self.result_stats)
+            info["entries"] = len(self.result_cache)
+        lookups = info["hits"] + info["misses"]
+        info["hit_rate"] = info["hits"] / lookups if lookups else 0.0
+        return info
+
+    def engine(self, analyze: bool = False):
+        """Returns the functions and the start state for searching
+
+:param analyze: If True, the successors are for OutSyms instead of InSyms
+:return: A tuple (successors, start_state, final, start_lookahead) where the functions are either for StateTuples or for ProductStates depending on use_product
+"""
+        start_tpl = tuple(0 for r in self.rule_table_lst)
+        if self.use_product:
+            with self.product_lock:
+                product = self.product
+                start_state = self.product_state(product, start_tpl)
+            product_final_lst = product.final_lst
+            return (partial(self.product_out_successors if analyze
+                            else self.product_successors, product),
+                    start_state,
+                    lambda state: product_final_lst[state],
+                    self.lookahead(start_tpl))
+        else:
+            return (self.tuple_out_successors if analyze
+                    else self.tuple_successors,
+                    start_tpl, self.is_final, self.lookahead(start_tpl))
+
+    def path_search(self, insym_lst: List[InSym]) -> Iterator[OutSymWord]:
+        """Yields the surface forms of a tokenized morphophonemic word
+
+:param insym_lst: The InSyms of the word to be generated
+
+The search is depth-first but iterative, with one frame for each
+position of the word on an explicit stack.  A configuration, i.e. a
+position together with the tuple of the states of all rules (or a
+state of the product automaton, if use_product is True), from which
+no final configuration can be reached is remembered, and a branch
+which leads into such a configuration again is pruned.  A branch is
+pruned also if some rule cannot accept the InSyms of the rest of the
+word, see lookahead(), if use_lookahead is True.  The surface forms
+are yielded as soon as they are found.
+"""
+        word_len = len(insym_lst)
+        dead_set: Set[Tuple[int, Union[StateTuple, ProductState]]] = set()
+        outsym_lst: List[OutSym] = []
+        successors, start_state, final, (allowed, required) = self.engine()
+        pruning = bool(self.lookahead_lst)
+        if pruning:
+            suffix_mask_lst = self.suffix_masks(insym_lst)
+            if (suffix_mask_lst[0] & ~allowed or
+                required & ~suffix_mask_lst[0]):
                 return
-        res = "".join(outsym_lst)
-        result_lst.append(res)
+
+        def new_frame(pos: int, state) -> list:
+            """Returns [pos, state, successor iterator, found]"""
+            succ_iter = (iter(successors(state, insym_lst[pos]))
+                         if pos < word_len else None)
+            return [pos, state, succ_iter, False]
+
+        stack = [new_frame(0, start_state)]
+        while stack:
+            frame = stack[-1]
+            pos, state, succ_iter, found = frame
+            if pos < word_len:
+                if pruning:
+                    suffix_mask = suffix_mask_lst[pos + 1]
+                for pair_id, new_state, (allowed, required) in succ_iter:
+                    if (pos + 1, new_state) in dead_set:
+                        continue
+                    if pruning and (suffix_mask & ~allowed or
+                                    required & ~suffix_mask):
+                        continue
+                    outsym_lst.append(cfg.sympair_lst[pair_id][1])
+                    stack.append(new_frame(pos + 1, new_state))
+                    break
+                else:
+                    succ_iter = None
+                if succ_iter is not None:
+                    continue
+            elif final(state):
+                found = True
+                yield "".join(outsym_lst)
+            stack.pop()
+            if not found:
+                dead_set.add((pos, state))
+            if stack:
+                outsym_lst.pop()
+                if found:
+                    stack[-1][3] = True
         return
-    insym = insym_lst[0]
-    pair_set = pairs_with_insym[insym]
-    for insym, outsym in pair_set:
-        new_state_lst = []
-        for state, rule_d in zip(state_lst, rule_dict_lst):
-            if (insym, outsym) in rule_d[state]:
-                new_state_lst.append(rule_d[state][(insym, outsym)])
+
+    def tokenize(self, word: InSymWord) -> Optional[List[InSym]]:
+        """Splits a morphophonemic word into InSyms
+
+:return: The list of InSyms or None if some InSym is not in the alphabet
+"""
+        insym_lst = re.findall(r"{[^{}]+}|[^{+}]|\+[A-Z][A-Z0-9\b]*", word)
+        # print(insym_lst) ###
+        for insym in insym_lst:
+            if insym not in self.input_alphabet:
+                print(insym, "not in input alphabet")
+                return None
+        return insym_lst
+
+    def generate(self, word: InSymWord) -> list[OutSymWord]:
+        """Returns the surface forms of a morphophonemic word
+
+:param word: a morphophonemic representation, e.g. "ham{pm}as"
+:return: the list of surface forms, empty if some InSym is not in the alphabet
+"""
+        insym_lst = self.tokenize(word)
+        if insym_lst is None:
+            return []
+        if not self.result_cache_size:
+            return list(self.path_search(insym_lst))
+        key = tuple(insym_lst)
+        cached = self.cached_result(key)
+        if cached is not None:
+            return list(cached)
+        result = list(self.path_search(insym_lst))
+        self.cache_result(key, result)
+        return result
+
+    def generate_many(self, words: List[InSymWord]
+                      ) -> List[List[OutSymWord]]:
+        """Returns the surface forms of many morphophonemic words
+
+:param words: morphophonemic representations, e.g. stems with different endings
+:return: a list of the lists of surface forms in the order of the words
+
+The words are put into a trie of InSyms and the trie is searched in
+one go, so that the rules are advanced along a common prefix of
+several words only once.  As in path_search(), the configurations of
+a trie node and the rule states from which no word can be completed
+are remembered and not entered again, and if use_lookahead is True, a
+child is not entered if the Lookahead of the rules excludes all words
+below it.  Words whose surface forms are in the result cache are left
+out of the trie.
+"""
+        result_lst: List[List[OutSymWord]] = [[] for word in words]
+        children_lst: List[Dict[InSym, int]] = [{}]
+        ends_lst: List[List[int]] = [[]]
+        miss_dict: Dict[int, Tuple[InSym, ...]] = {}
+        for i, word in enumerate(words):
+            insym_lst = self.tokenize(word)
+            if insym_lst is None:
+                continue
+            if self.result_cache_size:
+                key = tuple(insym_lst)
+                cached = self.cached_result(key)
+                if cached is not None:
+                    result_lst[i] = list(cached)
+                    continue
+                miss_dict[i] = key
+            node = 0
+            for insym in insym_lst:
+                if insym not in children_lst[node]:
+                    children_lst[node][insym] = len(children_lst)
+                    children_lst.append({})
+                    ends_lst.append([])
+                node = children_lst[node][insym]
+            ends_lst[node].append(i)
+
+        # the InSyms which occur in the rest of every word and of some word
+        # below a node, the children have greater numbers than their parents
+        pruning = bool(self.lookahead_lst)
+        every_mask_lst = [0] * len(children_lst)
+        some_mask_lst = [0] * len(children_lst)
+        for node in range(len(children_lst) - 1 if pruning else -1, -1, -1):
+            if children_lst[node] and not ends_lst[node]:
+                every_mask_lst[node] = -1
+            for insym, child in children_lst[node].items():
+                bit = self.insym_bit_dict[insym]
+                if not ends_lst[node]:
+                    every_mask_lst[node] &= bit | every_mask_lst[child]
+                some_mask_lst[node] |= bit | some_mask_lst[child]
+
+        successors, start_state, final, (allowed, required) = self.engine()
+        dead_set: Set[Tuple[int, Union[StateTuple, ProductState]]] = set()
+        outsym_lst: List[OutSym] = []
+
+        def succ_gen(node: int, state):
+            """Yields (child, pair id, new state, Lookahead) for all children"""
+            for insym, child in children_lst[node].items():
+                for pair_id, new_state, look in successors(state, insym):
+                    yield child, pair_id, new_state, look
+
+        def new_frame(node: int, state) -> list:
+            """Returns [node, state, successor iterator, found]"""
+            found = False
+            if ends_lst[node] and final(state):
+                found = True
+                surface = "".join(outsym_lst)
+                for i in ends_lst[node]:
+                    result_lst[i].append(surface)
+            return [node, state, succ_gen(node, state), found]
+
+        if every_mask_lst[0] & ~allowed or required & ~some_mask_lst[0]:
+            stack = []
+        else:
+            stack = [new_frame(0, start_state)]
+        while stack:
+            frame = stack[-1]
+            node, state, succ_iter, found = frame
+            for child, pair_id, new_state, (allowed, required) in succ_iter:
+                if (child, new_state) in dead_set:
+                    continue
+                if pruning and (every_mask_lst[child] & ~allowed or
+                                required & ~some_mask_lst[child]):
+                    continue
+                outsym_lst.append(cfg.sympair_lst[pair_id][1])
+                stack.append(new_frame(child, new_state))
+                break
             else:
+                stack.pop()
+                if not found:
+                    dead_set.add((node, state))
+                if stack:
+                    outsym_lst.pop()
+                    if found:
+                        stack[-1][3] = True
+        for i, key in miss_dict.items():
+            self.cache_result(key, result_lst[i])
+        return result_lst
+
+    def tokenize_surface(self, word: OutSymWord) -> Optional[List[OutSym]]:
+        """Splits a surface word into OutSyms, one for each grapheme
+
+:return: The list of OutSyms or None if some OutSym is not in the alphabet
+"""
+        outsym_lst = list(grapheme.graphemes(word))
+        for outsym in outsym_lst:
+            if outsym not in self.output_alphabet:
+                print(outsym, "not in output alphabet")
+                return None
+        return outsym_lst
+
+    def analysis_search(self, outsym_lst: List[OutSym]
+                        ) -> Iterator[InSymWord]:
+        """Yields the morphophonemic forms of a tokenized surface word
+
+:param outsym_lst: The OutSyms of the surface word
+
+The search goes as in path_search() but along the OutSyms of the
+pairs.  In addition, pairs whose OutSym is ZERO are inserted wherever
+the rules accept them, at most max_zeros of them, and the number of
+zeros inserted so far is part of the configuration.  Each
+morphophonemic form is yielded only once.
+"""
+        word_len = len(outsym_lst)
+        max_zeros = self.max_zeros
+        dead_set: Set[Tuple[int, int,
+                            Union[StateTuple, ProductState]]] = set()
+        yielded_set: Set[InSymWord] = set()
+        insym_lst: List[InSym] = []
+        successors, start_state, final, start_lookahead = \
+            self.engine(analyze=True)
+
+        def succ_gen(pos: int, zeros: int, state):
+            """Yields (next position, zeros, pair id, new state)"""
+            if pos < word_len:
+                for pair_id, new_state, look in successors(state,
+                                                           outsym_lst[pos]):
+                    yield pos + 1, zeros, pair_id, new_state
+            if zeros < max_zeros:
+                for pair_id, new_state, look in successors(state, ZERO):
+                    yield pos, zeros + 1, pair_id, new_state
+
+        def new_frame(pos: int, zeros: int, state) -> list:
+            """Returns [(pos, zeros, state), successor iterator, found]"""
+            found = pos == word_len and final(state)
+            return [(pos, zeros, state), succ_gen(pos, zeros, state), found]
+
+        stack = [new_frame(0, 0, start_state)]
+        if stack[-1][2]:
+            yielded_set.add("")
+            yield ""
+        while stack:
+            frame = stack[-1]
+            config, succ_iter, found = frame
+            for pos, zeros, pair_id, new_state in succ_iter:
+                if (pos, zeros, new_state) in dead_set:
+                    continue
+                insym_lst.append(cfg.sympair_lst[pair_id][0])
+                stack.append(new_frame(pos, zeros, new_state))
+                if stack[-1][2]:
+                    analysis = "".join(insym_lst)
+                    if analysis not in yielded_set:
+                        yielded_set.add(analysis)
+                        yield analysis
                 break
-        else:
-            new_outsym_lst = outsym_lst.copy()
-            new_outsym_lst.append(outsym)
-            path_search(new_state_lst, insym_lst[1:], new_outsym_lst)
-        continue
-    
+            else:
+                stack.pop()
+                if not found:
+                    dead_set.add(config)
+                if stack:
+                    insym_lst.pop()
+                    if found:
+                        stack[-1][2] = True
+        return
+
+    def analyze(self, word: OutSymWord) -> List[InSymWord]:
+        """Returns the morphophonemic forms of a surface word
+
+:param word: a surface form without zeros, e.g. "hammas"
+:return: the list of morphophonemic forms which the rules allow, empty if some OutSym is not in the alphabet
+"""
+        outsym_lst = self.tokenize_surface(word)
+        if outsym_lst is None:
+            return []
+        return list(self.analysis_search(outsym_lst))
+
+    def analyze_many(self, words: List[OutSymWord]
+                     ) -> List[List[InSymWord]]:
+        """Returns the morphophonemic forms of many surface words
+
+:param words: surface forms without zeros
+:return: a list of the lists of morphophonemic forms in the order of the words
+
+The words are put into a trie of OutSyms which is searched in one go
+as in generate_many().  The zeros are inserted as in
+analysis_search() and the search stays at the same trie node.
+"""
+        result_lst: List[List[InSymWord]] = [[] for word in words]
+        result_set_lst: List[Set[InSymWord]] = [set() for word in words]
+        children_lst: List[Dict[OutSym, int]] = [{}]
+        ends_lst: List[List[int]] = [[]]
+        for i, word in enumerate(words):
+            outsym_lst = self.tokenize_surface(word)
+            if outsym_lst is None:
+                continue
+            node = 0
+            for outsym in outsym_lst:
+                if outsym not in children_lst[node]:
+                    children_lst[node][outsym] = len(children_lst)
+                    children_lst.append({})
+                    ends_lst.append([])
+                node = children_lst[node][outsym]
+            ends_lst[node].append(i)
+
+        max_zeros = self.max_zeros
+        successors, start_state, final, start_lookahead = \
+            self.engine(analyze=True)
+        dead_set: Set[Tuple[int, int,
+                            Union[StateTuple, ProductState]]] = set()
+        insym_lst: List[InSym] = []
+
+        def succ_gen(node: int, zeros: int, state):
+            """Yields (next node, zeros, pair id, new state)"""
+            for outsym, child in children_lst[node].items():
+                for pair_id, new_state, look in successors(state, outsym):
+                    yield child, zeros, pair_id, new_state
+            if zeros < max_zeros:
+                for pair_id, new_state, look in successors(state, ZERO):
+                    yield node, zeros + 1, pair_id, new_state
+
+        def new_frame(node: int, zeros: int, state) -> list:
+            """Returns [(node, zeros, state), successor iterator, found]"""
+            found = False
+            if ends_lst[node] and final(state):
+                found = True
+                analysis = "".join(insym_lst)
+                for i in ends_lst[node]:
+                    if analysis not in result_set_lst[i]:
+                        result_set_lst[i].add(analysis)
+                        result_lst[i].append(analysis)
+            return [(node, zeros, state), succ_gen(node, zeros, state), found]
+
+        stack = [new_frame(0, 0, start_state)]
+        while stack:
+            frame = stack[-1]
+            config, succ_iter, found = frame
+            for node, zeros, pair_id, new_state in succ_iter:
+                if (node, zeros, new_state) in dead_set:
+                    continue
+                insym_lst.append(cfg.sympair_lst[pair_id][0])
+                stack.append(new_frame(node, zeros, new_state))
+                break
+            else:
+                stack.pop()
+                if not found:
+                    dead_set.add(config)
+                if stack:
+                    insym_lst.pop()
+                    if found:
+                        stack[-1][2] = True
+        return result_lst
+
+    def batch(self, words: List[str], analyze: bool = False,
+              executor=None, chunk_size: int = 1000) -> List[List[str]]:
+        """Returns the results of generate_many() or analyze_many()
+
+:param words: the morphophonemic words, or the surface words if analyze is True
+:param executor: e.g. a concurrent.futures.ThreadPoolExecutor in which the chunks are processed concurrently, or None
+:param chunk_size: the number of words in one task of the executor
+:return: a list of the lists of results in the order of the words
+"""
+        many = self.analyze_many if analyze else self.generate_many
+        if executor is None:
+            return many(words)
+        result_lst: List[List[str]] = []
+        for chunk_result_lst in executor.map(
+                many, [words[i:i + chunk_size]
+                       for i in range(0, len(words), chunk_size)]):
+            result_lst.extend(chunk_result_lst)
+        return result_lst
+
+    async def batch_async(self, words: List[str], analyze: bool = False,
+                          executor=None,
+                          chunk_size: int = 1000) -> List[List[str]]:
+        """Returns the results of batch() without blocking the event loop
+
+The chunks of words are run in the executor, or in the default
+executor of the event loop if executor is None, and they are awaited
+together.
+"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        many = self.analyze_many if analyze else self.generate_many
+        chunk_result_lsts = await asyncio.gather(
+            *[loop.run_in_executor(executor, many, words[i:i + chunk_size])
+              for i in range(0, len(words), chunk_size)])
+        return [results for chunk_result_lst in chunk_result_lsts
+                for results in chunk_result_lst]
+
+
+default_generator = Generator()
+"""The Generator which the module level functions use"""
+
+
+def init(rule_file_name: str) -> None:
+    """Reads the rules into the default Generator, see Generator.load()"""
+    default_generator.load(rule_file_name)
+    return
+
+
+def export_tables(file_name: str) -> None:
+    """Writes the tables of the default Generator into a file"""
+    default_generator.export_tables(file_name)
     return
 
 
 def generate(word: InSymWord) -> list[OutSymWord]:
-    global result_lst, rule_dict_lst
-    result_lst = []
-    insym_lst = re.findall(r"{[^{}]+}|[^{+}]|\+[A-Z][A-Z0-9\b]*", word)
-    # print(insym_lst) ###
-    for insym in insym_lst:
-        if insym not in input_alphabet:
-            print(insym, "not in input alphabet")
-            return []
-    start_state_lst = [0 for r in rule_dict_lst]
-    path_search(start_state_lst, insym_lst, [])
-    return result_lst
+    """Returns the surface forms of a morphophonemic word, see
+Generator.generate()"""
+    return default_generator.generate(word)
+
+
+def generate_many(words: List[InSymWord]) -> List[List[OutSymWord]]:
+    """Returns the surface forms of many morphophonemic words, see
+Generator.generate_many()"""
+    return default_generator.generate_many(words)
+
+
+def analyze(word: OutSymWord) -> List[InSymWord]:
+    """Returns the morphophonemic forms of a surface word, see
+Generator.analyze()"""
+    return default_generator.analyze(word)
+
+
+def analyze_many(words: List[OutSymWord]) -> List[List[InSymWord]]:
+    """Returns the morphophonemic forms of many surface words, see
+Generator.analyze_many()"""
+    return default_generator.analyze_many(words)
+
+
+analysis_mode: bool = False
+"""If True, generate_lines() analyzes surface forms instead of
+generating them"""
+
+
+def generate_lines(line_lst: List[str]) -> str:
+    """Generates the words on lines as the twol-generate command does
+
+:param line_lst: lines of input, one morphophonemic word on each, or one surface word if analysis_mode is True
+:return: the output for the lines as one string
+"""
+    import io
+    import contextlib
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        for line_nl in line_lst:
+            line = line_nl.strip().replace(" ", "")
+            if analysis_mode:
+                res = analyze(OutSymWord(line))
+            else:
+                res = generate(InSymWord(line))
+            print("  -> ", res)
+            print()
+    return output.getvalue()
+
+
+def generate_chunk(line_lst: List[str]) -> Tuple[str, int, int, float]:
+    """Generates a chunk of lines in a worker process of the --jobs mode
+
+:return: a tuple (output, pid, number of lines, seconds)
+"""
+    import os
+    import time
+    start = time.perf_counter()
+    output = generate_lines(line_lst)
+    return output, os.getpid(), len(line_lst), time.perf_counter() - start
+
+
+def chunks(line_seq, chunk_size: int) -> Iterator[List[str]]:
+    """Yields lists of at most chunk_size lines"""
+    chunk = []
+    for line_nl in line_seq:
+        chunk.append(line_nl)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate_in_parallel(line_seq, jobs: int, chunk_size: int,
+                         out_file) -> None:
+    """Generates the words of the lines with a pool of worker processes
+
+The rules must have been read by init() before.  The workers are
+forked, so that they share the rule tables of this process.  The
+lines are given to the workers in chunks and the output is written in
+the order of the input.  The throughput and the number of lines and
+the time of each worker are reported to stderr.
+"""
+    import sys
+    import time
+    import multiprocessing
+    start = time.perf_counter()
+    worker_stats: Dict[int, List] = {}
+    line_count = 0
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=jobs) as pool:
+        for output, pid, count, seconds in pool.imap(
+                generate_chunk, chunks(line_seq, chunk_size)):
+            out_file.write(output)
+            stats = worker_stats.setdefault(pid, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += count
+            stats[2] += seconds
+            line_count += count
+    elapsed = time.perf_counter() - start
+    for i, (pid, (chunk_count, count, seconds)) in enumerate(
+            sorted(worker_stats.items())):
+        print("worker {}: {} chunks, {} words, {:.2f}s, {:.0f} words/s".format(
+            i + 1, chunk_count, count, seconds,
+            count / seconds if seconds else 0.0), file=sys.stderr)
+    print("{} words in {:.2f}s, {:.0f} words/s with {} jobs".format(
+        line_count, elapsed, line_count / elapsed if elapsed else 0.0,
+        jobs), file=sys.stderr)
+    return
+
+
+def print_cache_info(generator: Generator, file) -> None:
+    """Prints the size, the counters and the hit rate of the result cache"""
+    info = generator.result_cache_info()
+    print("result cache: {} entries, {} hits, {} misses, {} evictions,"
+          " hit rate {:.1%}".format(info["entries"], info["hits"],
+                                    info["misses"], info["evictions"],
+                                    info["hit_rate"]), file=file)
+    return
 
 
 def main():
-    import sys, re
+    import os, sys, re
     import argparse
 
     arpar = argparse.ArgumentParser(
         "twol-generate",
         description = (
             "Generates surface forms out of morphophonemic"
-            " representations."))
+            " representations or, with --analyze, morphophonemic"
+            " representations out of surface forms."))
     arpar.add_argument(
         "rulesfst",
-        help = "A .fst file containing all compiled rules of the grammar.",
+        help = ("A .fst file containing all compiled rules of the grammar"
+                " or a file written with --export."),
         default = "~/github/ofitwol/ofitwol/rules/rules-norm.fst")
+    arpar.add_argument(
+        "-p", "--product",
+        help = ("Generate using a product automaton of all rules"
+                " which is built lazily as the words need it."),
+        action = "store_true")
+    arpar.add_argument(
+        "--product-cache",
+        help = ("The maximum number of cached transition lists"
+                " of the product automaton, default is 100000."),
+        type = int, default = 100000)
+    arpar.add_argument(
+        "-l", "--lookahead",
+        help = ("Prune the search with precomputed masks of the"
+                " symbols which the rules still allow or require."
+                "  This helps only with rules which restrict"
+                " the rest of the word a lot."),
+        action = "store_true")
+    arpar.add_argument(
+        "-a", "--analyze",
+        help = ("Read surface forms and give the morphophonemic"
+                " representations which the rules allow."),
+        action = "store_true")
+    arpar.add_argument(
+        "-z", "--max-zeros",
+        help = ("The maximum number of zeros inserted into"
+                " a surface form when analyzing, default is 1."),
+        type = int, default = 1)
+    arpar.add_argument(
+        "-j", "--jobs",
+        help = ("The number of worker processes which generate"
+                " the words in parallel, default is 1."),
+        type = int, default = 1)
+    arpar.add_argument(
+        "--chunk-size",
+        help = ("The number of lines given to a worker process"
+                " at a time, default is 1000."),
+        type = int, default = 1000)
+    arpar.add_argument(
+        "--export",
+        help = ("Write the converted rules into this file and exit."
+                "  The file can be given instead of the .fst file"
+                " and it loads much faster."),
+        default = "")
+    arpar.add_argument(
+        "--cache",
+        help = ("Keep the surface forms of at most this many most"
+                " recently generated words and reuse them when the"
+                " same word comes again, default is 0, i.e. no cache."),
+        type = int, default = 0)
+    arpar.add_argument(
+        "--serve",
+        help = ("Keep the rules loaded and answer requests which are"
+                " lines of JSON on this Unix socket, or on stdin and"
+                " stdout if it is -, see twol.genserver."),
+        metavar = "SOCKET", default = "")
+    arpar.add_argument(
+        "--threads",
+        help = ("The number of threads which answer the requests"
+                " with --serve, default is the number of processors."),
+        type = int, default = os.cpu_count() or 4)
     args = arpar.parse_args()
-    
+
+    global analysis_mode
+    default_generator.use_product = args.product
+    default_generator.product_cache_size = args.product_cache
+    default_generator.max_zeros = args.max_zeros
+    default_generator.use_lookahead = args.lookahead
+    default_generator.result_cache_size = args.cache
+    analysis_mode = args.analyze
     init(args.rulesfst)
-    for line_nl in sys.stdin:
-        line = line_nl.strip().replace(" ", "")
-        res = generate(InSymWord(line))
-        print("  -> ", res)
-        print()
+    if args.export:
+        export_tables(args.export)
+        return
+    if args.serve:
+        import twol.genserver
+        twol.genserver.serve(default_generator, args.serve, args.threads)
+    elif args.jobs > 1:
+        generate_in_parallel(sys.stdin, args.jobs, args.chunk_size,
+                             sys.stdout)
+        return
+    else:
+        for line_nl in sys.stdin:
+            line = line_nl.strip().replace(" ", "")
+            if analysis_mode:
+                res = analyze(OutSymWord(line))
+            else:
+                res = generate(InSymWord(line))
+            print("  -> ", res)
+            print()
+    if default_generator.use_product:
+        product_stats = default_generator.product_stats
+        print("product automaton: {} states, {} hits, {} misses,"
+              " {} evictions, {} resets".format(
+                  len(default_generator.product.tpl_lst),
+                  product_stats["hits"], product_stats["misses"],
+                  product_stats["evictions"], product_stats["resets"]),
+              file=sys.stderr)
+    if default_generator.result_cache_size:
+        print_cache_info(default_generator, sys.stderr)
 
 if __name__ == "__main__":
     main()
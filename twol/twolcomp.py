@@ -6,6 +6,8 @@
 #
 import sys
 
+import os
+
 import re
 
 import fileinput
@@ -24,6 +26,16 @@ from twol.twparser import init as twparser_init
 
 from twol.twparser import parse_rule
 
+from twol.twparser import statement_op
+
+from twol.twparser import parse_statements
+
+from twol.twparser import evaluate_statement
+
+import twol.fs as fs
+
+import twol.rulecache as rulecache
+
 
 def print_raw_paths(paths):
     """For debugging only: print a FST path as a space-separated pairstring"""
@@ -34,6 +46,287 @@ def print_raw_paths(paths):
         print(' '.join(sym_list))
     return
 
+examples_fsa = None
+"""The examples as an encoded FSA, used for making negative examples"""
+
+examples_up_fsa = None
+"""The input projection of the examples"""
+
+def rule_statements(rule_file_lst):
+    """Reads rule files and yields the rules and definitions one by one
+
+    rule_file_lst -- a list of names of the rule files
+
+    Comments, empty lines and regions between STOP and START are
+    skipped.  A statement may extend over several lines and it ends
+    with a semicolon.
+
+    yields -- tuples (rule_str, line_no, line_nl_lst) where rule_str is
+    the statement as one line, line_no the number of its last line
+    and line_nl_lst the original lines
+    """
+    i = 0
+    skip = False
+    line_lst = []
+    for line_nl in fileinput.input(rule_file_lst):
+        i += 1
+        if not line_lst:
+            line_nl_lst = []
+        line_nl_lst.append(line_nl)
+        line = line_nl.split('!', maxsplit=1)[0].strip()
+        if line == "START":
+            skip = False
+            continue
+        elif line == "STOP":
+            skip = True
+        if skip or (not line) or line.startswith("!"):
+            continue
+        line_lst.append(line)
+        if not line.endswith(";"):
+            continue
+        else:
+            rule_str = " ".join(line_lst)
+            line_lst = []
+        yield rule_str, i, line_nl_lst
+    return
+
+def statement_trees(parser, statement_lst):
+    """Parses all rules and definitions in one pass
+
+    statement_lst -- a list of tuples given by rule_statements()
+
+    Returns a list of parse trees to be evaluated by process_statement(),
+    one for each statement.  The tree is None for statements which are
+    neither rules nor definitions.  If there are syntax errors, all
+    trees are None and the statements are parsed one by one as usual,
+    so that the errors are reported with their line numbers.
+    """
+    index_lst = [i for i, statement in enumerate(statement_lst)
+                 if statement_op(statement[0])]
+    tree_lst = [None] * len(statement_lst)
+    parsed_lst = parse_statements(parser,
+                                  [statement_lst[i][0] for i in index_lst])
+    if parsed_lst is None:
+        if cfg.verbosity > 0:
+            print("syntax errors, parsing the statements one by one")
+        return tree_lst
+    for i, tree in zip(index_lst, parsed_lst):
+        tree_lst[i] = tree
+    return tree_lst
+
+def compile_rule(op, left, right, line):
+    """Compiles one parsed rule
+
+    Returns a triple (R, selector_fst, MIXe) or None if op is not
+    a rule operator.
+    """
+    if op == "=>":
+        return twrule.rightarrow(line, left, *right)
+    elif op == "<=":
+        return twrule.output_coercion(line, left, *right)
+    elif op == "<--":
+        return twrule.input_coercion(line, left, *right)
+    elif op == "<=>":
+        return twrule.doublearrow(line, left, *right)
+    elif op == "/<=":
+        return twrule.center_exclusion(line, left, *right)
+    else:
+        print("Error: not a valid type of a rule", op)
+        return None
+
+def test_rule(op, R, selector_fst, MIXe, thorough):
+    """Tests a compiled rule against the positive and negative examples
+
+    Prints a report of the examples which were rejected or accepted
+    contrary to the expectations.
+    """
+    if thorough > 0:
+        selector_fst.intersect(cfg.examples_fst)
+        # selector_fst.n_best(5)
+        selector_fst.minimize()
+        if cfg.verbosity >= 20:
+            paths = selector_fst.extract_paths(output='raw')
+            print_raw_paths(paths[0:20])
+        passed_pos_examples_fst = selector_fst.copy()
+        passed_pos_examples_fst.intersect(R)
+        if thorough > 0:
+            if passed_pos_examples_fst.compare(selector_fst):
+                print("All positive examples accepted")
+            else:
+                lost_examples_fst = selector_fst.copy()
+                lost_examples_fst.minus(passed_pos_examples_fst)
+                lost_examples_fst.minimize()
+                print("** Some positive examples were rejected:")
+                lost_paths = lost_examples_fst.extract_paths(output='raw')
+                print_raw_paths(lost_paths[0:20])
+    if thorough > 1 and op in {"=>", "<=", "<=>", "<--"}:
+        neg_examples_fsa = examples_fsa.copy()
+        neg_examples_fsa.compose(MIXe)
+        neg_examples_fsa.output_project()
+        neg_examples_fst = hfst.fsa_to_fst(neg_examples_fsa, separator="^")
+        neg_examples_fst.minus(cfg.examples_fst)
+        NG = examples_up_fsa.copy()
+        NG.compose(neg_examples_fst)
+        npaths = NG.extract_paths(output='raw')
+        #print_raw_paths(npaths)
+        passed_neg_examples_fst = NG.copy()
+        passed_neg_examples_fst.intersect(R)
+        if passed_neg_examples_fst.compare(hfst.empty_fst()):
+            print("All negative examples rejected")
+        else:
+            print("** Some negative examples accepted:")
+            npaths = passed_neg_examples_fst.extract_paths(output='raw')
+            print_raw_paths(npaths[0:20])
+    return
+
+def process_statement(parser, rule_str, line_no, line_nl_lst, thorough,
+                      tree=None):
+    """Parses, compiles and tests one rule or definition
+
+    If a parse tree from statement_trees() is given, its semantic
+    actions are done instead of parsing the statement again.  A rule
+    which is found in the rule cache is neither parsed nor compiled.
+    In the incremental mode, a rule is tested only if some changed
+    example is relevant to it.
+
+    Returns the rule FST or None if the statement was a definition
+    or contained errors.
+    """
+    op = statement_op(rule_str)
+    cached = None
+    if op and op != "=":
+        cached = rulecache.load(rule_str)
+    if not cached:
+        if tree is not None:
+            op, left, right = evaluate_statement(tree, parser, rule_str,
+                                                 line_no, line_nl_lst)
+        else:
+            op, left, right = parse_rule(parser, rule_str, line_no,
+                                         line_nl_lst)
+        if op == "?" or not (left and right):
+            return None
+
+    if (thorough > 0 and op != "=") or cfg.verbosity > 0:
+        print("\n")
+        print(rule_str)
+
+    if op == "=":
+        rulecache.add_definition(left, rule_str)
+        #        if cfg.verbosity > 0:
+        #            print(line)
+        if cfg.verbosity >= 10:
+            print(left, op)
+            twbt.ppfst(right)
+        return None
+    if cached:
+        R, selector_fst, MIXe = cached
+        if cfg.verbosity >= 5:
+            print("(loaded from the rule cache)")
+    else:
+        result = compile_rule(op, left, right, rule_str)
+        if result is None:
+            return None
+        R, selector_fst, MIXe = result
+        R.set_name(rule_str[:30])
+        rulecache.store(rule_str, R, selector_fst, MIXe)
+    if cfg.verbosity >= 10:
+        twbt.ppfst(R)
+    if not incremental:
+        test_rule(op, R, selector_fst, MIXe, thorough)
+        return R
+    report = rulecache.stored_verdict(rule_str, thorough)
+    if report is None or rulecache.is_affected(op, selector_fst, MIXe):
+        import io
+        import contextlib
+        report_io = io.StringIO()
+        with contextlib.redirect_stdout(report_io):
+            test_rule(op, R, selector_fst, MIXe, thorough)
+        report = report_io.getvalue()
+    elif cfg.verbosity >= 5:
+        print("(test results of the previous run)")
+    print(report, end="")
+    rulecache.record_verdict(rule_str, thorough, report)
+    return R
+
+incremental = False
+"""Whether to reuse the test results of rules unaffected by changes
+in the examples"""
+
+worker_parser = None
+worker_thorough = 0
+worker_keep_fsts = False
+
+def process_in_worker(statement):
+    """Processes one rule in a worker process of the --jobs mode
+
+    The worker inherits the parser, the definitions and the common FSTs
+    from the parent process when it is forked.  The report is collected
+    into a string so that the parent can print the reports in the order
+    of the rules.
+
+    Returns a tuple (report, rule_bytes, verdict_dict, memo_stats)
+    where rule_bytes is the rule FST in binary form or None,
+    verdict_dict contains the test results recorded for the incremental
+    mode and memo_stats the counts of reused context conditions.
+    """
+    import io
+    import contextlib
+    rule_str, line_no, line_nl_lst, tree = statement
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
+        R = process_statement(worker_parser, rule_str, line_no,
+                              line_nl_lst, worker_thorough, tree)
+    if R is not None and worker_keep_fsts:
+        rule_bytes = fs.fst_to_bytes(R)
+    else:
+        rule_bytes = None
+    verdict_dict = rulecache.new_verdict_dict.copy()
+    rulecache.new_verdict_dict.clear()
+    memo_stats = twrule.context_memo_stats.copy()
+    for key in twrule.context_memo_stats:
+        twrule.context_memo_stats[key] = 0
+    return report.getvalue(), rule_bytes, verdict_dict, memo_stats
+
+def process_in_parallel(parser, statement_lst, tree_lst, jobs, thorough,
+                        keep_fsts):
+    """Compiles and tests the rules in a pool of worker processes
+
+    statement_lst -- the tuples given by rule_statements()
+
+    tree_lst -- the parse trees given by statement_trees() or Nones
+
+    All definitions are processed first in this process and the rules
+    are then distributed to the workers together with their parse
+    trees.  The reports are printed and the rule FSTs are returned in
+    the order of the rules in the source.
+    """
+    global worker_parser, worker_thorough, worker_keep_fsts
+    import multiprocessing
+    rule_statement_lst = []
+    for statement, tree in zip(statement_lst, tree_lst):
+        rule_str = statement[0]
+        if statement_op(rule_str) == "=":
+            process_statement(parser, *statement, thorough, tree)
+        else:
+            rule_statement_lst.append(statement + (tree,))
+    twrule.require_base()
+    worker_parser = parser
+    worker_thorough = thorough
+    worker_keep_fsts = keep_fsts
+    rule_fst_lst = []
+    sys.stdout.flush()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=jobs) as pool:
+        for report, rule_bytes, verdict_dict, memo_stats in pool.imap(
+                process_in_worker, rule_statement_lst):
+            print(report, end="")
+            rulecache.new_verdict_dict.update(verdict_dict)
+            for key, count in memo_stats.items():
+                twrule.context_memo_stats[key] += count
+            if rule_bytes is not None:
+                rule_fst_lst.append(fs.bytes_to_fst(rule_bytes))
+    return rule_fst_lst
+
 def main():
 
     version = cfg.timestamp(__file__)
@@ -79,6 +372,35 @@ def main():
         " 2 against both positive and negative examples."\
         " Default is 2.",
         type=int, choices=[0, 1, 2], default=2)
+    arpar.add_argument(
+        "-j", "--jobs",
+        help="number of worker processes which compile and test"\
+        " the rules in parallel, all definitions are parsed before"\
+        " the rules.  Default is 1, i.e. no worker processes.",
+        type=int, default=1)
+    arpar.add_argument(
+        "-c", "--cache",
+        help="directory where compiled rules are cached between runs;"\
+        " a rule is recompiled only if its text, the definitions it"\
+        " uses or the alphabet of the examples have changed",
+        default="")
+    arpar.add_argument(
+        "-i", "--incremental",
+        help="test only those rules which are affected by the examples"\
+        " that were added or removed since the previous run and reuse"\
+        " the earlier results for the other rules, requires --cache",
+        action="store_true")
+    arpar.add_argument(
+        "-p", "--one-pass",
+        help="parse all rules and definitions in one pass before"\
+        " compiling them; if there are syntax errors, the statements"\
+        " are parsed one by one as without this option",
+        action="store_true")
+    arpar.add_argument(
+        "--shards",
+        help="number of parts in which the FST of PSTR examples is"\
+        " built in parallel, useful for very large sets of examples",
+        type=int, default=1)
     arpar.add_argument(
         "--recursion",
         help="set the limit for recursion depth",
@@ -97,13 +419,14 @@ def main():
     if len(args.examples) == 1 and args.examples[0].endswith(".fst"):
         twexamp.read_fst(args.examples[0])
     else:
-        twexamp.read_examples(args.examples)
+        twexamp.read_examples(args.examples, shards=args.shards)
 
     if cfg.verbosity >= 30:
         twbt.ppfst(cfg.examples_fst, title="examples_fst")
 
     parser = twparser_init()
 
+    global examples_fsa, examples_up_fsa
     examples_fsa = hfst.fst_to_fsa(cfg.examples_fst, separator="^")
 
     examples_up_fsa = cfg.examples_fst.copy()
@@ -111,103 +434,52 @@ def main():
     if cfg.verbosity >= 30:
         twbt.ppfst(examples_up_fsa, title="examples_up_fsa")
 
-    twrule.init()
-
-    i = 0
-    skip = False
-    all_rules_fst_lst = []
-    line_lst = []
-
-    for line_nl in fileinput.input(args.rules):
-        i += 1
-        if not line_lst:
-            line_nl_lst = []
-        line_nl_lst.append(line_nl)
-        line = line_nl.split('!', maxsplit=1)[0].strip()
-        if line == "START":
-            skip = False
-            continue
-        elif line == "STOP":
-            skip = True
-        if skip or (not line) or line.startswith("!"):
-            continue
-        line_lst.append(line)
-        if not line.endswith(";"):
-            continue
-        else:
-            rule_str = " ".join(line_lst)
-            line_lst = []
+    if len(args.examples) == 1 and args.examples[0].endswith(".fst"):
+        base_file = "{}-base-{}.base".format(args.examples[0][:-4],
+                                            cfg.pair_alphabet_digest()[:16])
+    elif args.cache:
+        base_file = os.path.join(args.cache, "base-{}.base".format(
+            cfg.pair_alphabet_digest()[:16]))
+    else:
+        base_file = ""
+    twrule.init(base_file)
 
-        op, left, right = parse_rule(parser, rule_str, i, line_nl_lst)
-        if op == "?" or not (left and right):
-            continue
+    global incremental
+    if args.cache:
+        rulecache.init(args.cache)
+    if args.incremental:
+        if not args.cache:
+            exit("--incremental requires --cache")
+        if not cfg.example_set:
+            exit("--incremental requires examples in PSTR form")
+        incremental = True
+        change_count = rulecache.init_incremental(cfg.example_set)
+        if change_count is None:
+            print("no results of a previous run, testing all rules")
+        elif cfg.verbosity > 0:
+            print(change_count, "examples changed since the previous run")
 
-        if (args.thorough > 0 and op != "=") or cfg.verbosity > 0:
-            print("\n")
-            print(rule_str)
+    keep_fsts = bool(args.lost or args.wrong or args.output)
+    statement_lst = list(rule_statements(args.rules))
+    if args.one_pass:
+        tree_lst = statement_trees(parser, statement_lst)
+    else:
+        tree_lst = [None] * len(statement_lst)
+    if args.jobs > 1:
+        all_rules_fst_lst = process_in_parallel(parser, statement_lst,
+                                                tree_lst, args.jobs,
+                                                args.thorough, keep_fsts)
+    else:
+        all_rules_fst_lst = []
+        for statement, tree in zip(statement_lst, tree_lst):
+            R = process_statement(parser, *statement, args.thorough, tree)
+            if R is not None and keep_fsts:
+                all_rules_fst_lst.append(R)
 
-        if op == "=":
-            #        if cfg.verbosity > 0:
-            #            print(line)
-            if cfg.verbosity >= 10:
-                print(left, op)
-                twbt.ppfst(right)
-            continue
-        elif op == "=>":
-            R, selector_fst, MIXe = twrule.rightarrow(line, left, *right)
-        elif op == "<=":
-            R, selector_fst, MIXe = twrule.output_coercion(line, left, *right)
-        elif op == "<--":
-            R, selector_fst, MIXe = twrule.input_coercion(line, left, *right)
-        elif op == "<=>":
-            R, selector_fst, MIXe = twrule.doublearrow(line, left, *right)
-        elif op == "/<=":
-            R, selector_fst, MIXe = twrule.center_exclusion(line, left, *right)
-        else:
-            print("Error: not a valid type of a rule", op)
-            continue
-        R.set_name(rule_str[:30])
-        if cfg.verbosity >= 10:
-            twbt.ppfst(R)
-        if args.lost or args.wrong or args.output:
-            all_rules_fst_lst.append(R)
-        if args.thorough > 0:
-            selector_fst.intersect(cfg.examples_fst)
-            # selector_fst.n_best(5)
-            selector_fst.minimize()
-            if cfg.verbosity >= 20:
-                paths = selector_fst.extract_paths(output='raw')
-                print_raw_paths(paths[0:20])
-            passed_pos_examples_fst = selector_fst.copy()
-            passed_pos_examples_fst.intersect(R)
-            if args.thorough > 0:
-                if passed_pos_examples_fst.compare(selector_fst):
-                    print("All positive examples accepted")
-                else:
-                    lost_examples_fst = selector_fst.copy()
-                    lost_examples_fst.minus(passed_pos_examples_fst)
-                    lost_examples_fst.minimize()
-                    print("** Some positive examples were rejected:")
-                    lost_paths = lost_examples_fst.extract_paths(output='raw')
-                    print_raw_paths(lost_paths[0:20])
-        if args.thorough > 1 and op in {"=>", "<=", "<=>", "<--"}:
-            neg_examples_fsa = examples_fsa.copy()
-            neg_examples_fsa.compose(MIXe)
-            neg_examples_fsa.output_project()
-            neg_examples_fst = hfst.fsa_to_fst(neg_examples_fsa, separator="^")
-            neg_examples_fst.minus(cfg.examples_fst)
-            NG = examples_up_fsa.copy()
-            NG.compose(neg_examples_fst)
-            npaths = NG.extract_paths(output='raw')
-            #print_raw_paths(npaths)
-            passed_neg_examples_fst = NG.copy()
-            passed_neg_examples_fst.intersect(R)
-            if passed_neg_examples_fst.compare(hfst.empty_fst()):
-                print("All negative examples rejected")
-            else:
-                print("** Some negative examples accepted:")
-                npaths = passed_neg_examples_fst.extract_paths(output='raw')
-                print_raw_paths(npaths[0:20])
+    if incremental:
+        rulecache.save_incremental(cfg.example_set)
+    if cfg.verbosity >= 5:
+        twrule.print_context_memo_stats()
 
     if args.lost or args.wrong:
         RESU = examples_up_fsa.copy()
@@ -24,13 +24,43 @@ import twol.cfg as cfg
 
 import twol.twexamp as twexamp
 
+one_sym_pair_fst_cache = {}
+"""FSTs built by one_sym_pair_fst(), indexed by the symbol pair"""
+
 def one_sym_pair_fst(insym, outsym):
-    fst = hfst.HfstBasicTransducer()
-    fst.add_state(1)
-    fst.set_final_weight(1, 0.0)
-    tr = hfst.HfstBasicTransition(1, insym, outsym, 0.0)
-    fst.add_transition(0, tr)
-    return  hfst.HfstTransducer(fst)
+    """Returns a copy of a cached FST which accepts just insym:outsym"""
+    if (insym, outsym) not in one_sym_pair_fst_cache:
+        fst = hfst.HfstBasicTransducer()
+        fst.add_state(1)
+        fst.set_final_weight(1, 0.0)
+        tr = hfst.HfstBasicTransition(1, insym, outsym, 0.0)
+        fst.add_transition(0, tr)
+        one_sym_pair_fst_cache[(insym, outsym)] = hfst.HfstTransducer(fst)
+    return one_sym_pair_fst_cache[(insym, outsym)].copy()
+
+def half_pair_fst(up, lo):
+    """Returns an FST for a pair where either side is missing
+
+    up -- an input symbol or "" if it is missing
+
+    lo -- an output symbol or "" if it is missing
+
+    Returns a copy of a cached FST which accepts any one pair in the
+    alphabet whose input symbol is up (if lo is missing) or whose output
+    symbol is lo (if up is missing).  The pairs are taken from the
+    indexes built by twexamp.index_pair_symbols() which also empties
+    the cache twexamp.half_pair_fst_cache.
+    """
+    half_pair_fst_cache = twexamp.half_pair_fst_cache
+    if (up, lo) not in half_pair_fst_cache:
+        if up:
+            pairsym_set = cfg.insym2pairsym_set.get(up, set())
+        else:
+            pairsym_set = cfg.outsym2pairsym_set.get(lo, set())
+        sympair_lst = [cfg.pairsym2sympair(pairsym)
+                       for pairsym in sorted(pairsym_set)]
+        half_pair_fst_cache[(up, lo)] = twexamp.pairs_to_fst(sympair_lst)
+    return half_pair_fst_cache[(up, lo)].copy()
 
 class DiscovDefSemantics(object):
 
@@ -59,13 +89,13 @@ class DiscovDefSemantics(object):
         For a single symbol pair k:g.m it is equivalent to k:
         """
         pairsym_set = ast.expr.copy()
+        result_set = set()
         insym_set = set()
-        for sympair in pairsym_set:
+        for pairsym in pairsym_set:
             insym, outsym = cfg.pairsym2sympair(pairsym)
-            insym_set.add(outsym)
-        for insymbol, outsymbol in cfg.symbol_pair_set:
-            if insymbol in insym_set:
-                result_set.add(cfg.sympaif2pairsym(insymbol, outsymbol))
+            insym_set.add(insym)
+        for insym in insym_set:
+            result_set |= cfg.insym2pairsym_set.get(insym, set())
         return result_set
 
     def Surface(self, ast):
@@ -81,9 +111,8 @@ class DiscovDefSemantics(object):
         for pairsym in pairsym_set:
             insym, outsym = cfg.pairsym2sympair(pairsym)
             outsym_set.add(outsym)
-        for insymbol, outsymbol in cfg.symbol_pair_set:
-            if outsymbol in outsym_set:
-                result_set.add(cfg.sympaif2pairsym(insymbol, outsymbol))
+        for outsym in outsym_set:
+            result_set |= cfg.outsym2pairsym_set.get(outsym, set())
         return result_set
 
     def pair(self, ast):
@@ -110,16 +139,10 @@ class DiscovDefSemantics(object):
             result_set = set([f"{up}:{lo}"])
             return result_set
         elif up and (not lo):   # it is e.g. "{aØ}:"
-            result_set = set()
-            for insym, outsym in cfg.symbol_pair_set:
-                if insym == up:
-                    result_set.add(cfg.sympair2pairsym(insym, outsym))
+            result_set = cfg.insym2pairsym_set.get(up, set()).copy()
             return result_set
         elif (not up) and lo:   # it is e.g. ":i"
-            result_set = set()
-            for insym, outsym in cfg.symbol_pair_set:
-                if outsym == lo:
-                    result_set.add(cfg.sympair2pairsym(insym, outsym))
+            result_set = cfg.outsym2pairsym_set.get(lo, set()).copy()
             return result_set
         else:                   # it is ":"
             result_set = cfg.pair_symbol_set.copy()
@@ -335,14 +358,11 @@ class TwolFstSemantics(object):
             result_fst.set_name(f"{up}:{lo}")
             return result_fst
         elif up and (not lo):   # it is e.g. "{aØ}:"
-            result_fst = one_sym_pair_fst(up, up)
-            result_fst.compose(cfg.all_pairs_fst)
+            result_fst = half_pair_fst(up, "")
             result_fst.set_name(f"{up}:")
             return result_fst
         elif (not up) and lo:   # it is e.g. ":i"
-            result_fst = cfg.all_pairs_fst.copy()
-            lo_fst = one_sym_pair_fst(lo, lo)
-            result_fst.compose(lo_fst)
+            result_fst = half_pair_fst("", lo)
             result_fst.set_name(f":{lo}")
             return result_fst
         else:                   # it is ":"
@@ -384,6 +404,172 @@ class TwolFstSemantics(object):
         result_fst.set_name(".#.")
         return result_fst
 
+class Deferred(object):
+    """A node of a parse tree whose semantic action has not been done yet
+
+    rule -- the name of the grammar rule, e.g. 'union'
+
+    ast -- the node as TatSu gave it to the semantic action
+    """
+
+    def __init__(self, rule, ast):
+        self.rule = rule
+        self.ast = ast
+
+    def __repr__(self):
+        return "Deferred({!r}, {!r})".format(self.rule, self.ast)
+
+class DeferredSemantics(object):
+    """Semantics which only record the nodes for evaluate()
+
+    For each rule which has an action in TwolFstSemantics, a Deferred
+    node is returned.  Such a parse tree contains no FSTs and it can
+    be pickled.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not hasattr(TwolFstSemantics, name):
+            raise AttributeError(name)
+        return lambda ast: Deferred(name, ast)
+
+def evaluate(node, semantics):
+    """Performs the deferred semantic actions of a parse tree
+
+    node -- a parse tree produced with DeferredSemantics
+
+    semantics -- e.g. TwolFstSemantics()
+
+    The actions are done bottom-up as they would have been done during
+    the parsing.  Returns the result of the action of the top node.
+    FailedSemantics is raised if an action fails.
+    """
+    if isinstance(node, Deferred):
+        ast = evaluate(node.ast, semantics)
+        return getattr(semantics, node.rule)(ast)
+    elif isinstance(node, AST):
+        return AST({key: evaluate(value, semantics)
+                    for key, value in node.items()})
+    elif isinstance(node, (list, tuple)):
+        return type(node)(evaluate(item, semantics) for item in node)
+    else:
+        return node
+
+def parse_statements(parser, rule_str_lst):
+    """Parses all statements in one pass without semantic actions
+
+    parser -- a parser returned by init()
+
+    rule_str_lst -- rules and definitions, each as one line
+
+    Returns a list of parse trees, one for each statement, which can
+    be evaluated later with evaluate_statement(), possibly in another
+    process.  If the statements cannot be parsed as a whole, None is
+    returned and the statements have to be parsed one by one with
+    parse_rule() which reports the errors.
+    """
+    text = "\n".join(rule_str_lst)
+    try:
+        tree_lst = parser.parse(text, start="file_start",
+                                semantics=DeferredSemantics())
+    except ParseException:
+        return None
+    if len(tree_lst) != len(rule_str_lst):
+        return None  # some line contained more than one statement
+    return list(tree_lst)
+
+def evaluate_statement(tree, parser, line_nl, line_no, line_lst):
+    """Performs the semantic actions for one statement
+
+    tree -- a parse tree of a statement from parse_statements()
+
+    The other arguments are as for parse_rule().  Returns the same
+    as parse_rule().  If an action fails, e.g. because of a symbol
+    not in the alphabet, the statement is parsed again with
+    parse_rule() which reports the error as usual.
+    """
+    try:
+        return evaluate(tree, TwolFstSemantics())
+    except FailedSemantics:
+        cfg.error_message = ""
+        return parse_rule(parser, line_nl, line_no, line_lst)
+
+def cached_parser(grammar, name):
+    """Returns a parser for a grammar using a generated parser module
+
+    grammar -- an EBNF grammar as a string
+
+    name -- the name of the grammar, e.g. "TwolCSyntax"
+
+    Compiling a grammar with TatSu takes a noticeable time.  Therefore,
+    the grammar is converted into Python source code on first use and
+    stored in the cache directory (see cfg.cache_directory()).  Later,
+    the parser is loaded from there.  The name of the module contains
+    a digest of the grammar and the TatSu version, so that any change
+    in them causes a new module to be generated.  The first line of
+    the module holds a digest of the grammar and of the rest of the
+    source, and the source is executed only if that digest matches and
+    the cache directory and the module are accessible to their owner
+    only.  If the cache cannot be used or the module in it cannot be
+    loaded, the grammar is compiled as such.
+    """
+    import os
+    import stat
+    import types
+    import hashlib
+    import builtins
+    cache_dir = cfg.cache_directory()
+    if not cache_dir:
+        return compile(grammar)
+    key_str = tatsu.__version__ + "\n" + grammar
+    digest = hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+    module_name = "{}_{}".format(name, digest[:16])
+    file_name = os.path.join(cache_dir, module_name + ".py")
+
+    def source_digest(source):
+        return hashlib.sha256((key_str + "\n" + source).encode("utf-8")
+                              ).hexdigest()
+
+    def private(path):
+        st = os.stat(path)
+        return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+    if not os.path.isfile(file_name):
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            if not private(cache_dir):
+                return compile(grammar)
+            source = tatsu.to_python_sourcecode(grammar, name=name)
+            temp_name = "{}.{}.tmp".format(file_name, os.getpid())
+            fd = os.open(temp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         stat.S_IRUSR | stat.S_IWUSR)
+            with builtins.open(fd, "w", encoding="utf-8") as fil:
+                fil.write("# sha256 {}\n".format(source_digest(source)))
+                fil.write(source)
+            os.replace(temp_name, file_name)
+        except OSError:
+            return compile(grammar)
+    try:
+        if not (private(cache_dir) and private(file_name)):
+            return compile(grammar)
+        with builtins.open(file_name, encoding="utf-8") as fil:
+            header = fil.readline()
+            source = fil.read()
+        if header != "# sha256 {}\n".format(source_digest(source)):
+            raise ValueError("digest mismatch in " + file_name)
+        module = types.ModuleType(module_name)
+        module.__file__ = file_name
+        code = builtins.compile(source, file_name, "exec")
+        exec(code, module.__dict__)
+        return getattr(module, name + "Parser")()
+    except Exception:
+        # a truncated or otherwise broken module, it is generated again
+        # next time
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
+        return compile(grammar)
+
 def init():
     """Initializes the module and compiles and returns a tatsu parser
 
@@ -393,10 +579,23 @@ def init():
     import os
     dir = os.path.dirname(os.path.abspath(__file__))
     grammar_file = dir + "/twolcsyntax.ebnf"
-    grammar = open(grammar_file).read()
-    parser = compile(grammar)
+    grammar = open(grammar_file, encoding="utf-8").read()
+    parser = cached_parser(grammar, "TwolCSyntax")
     return parser
 
+rule_op_pattern = re.compile(r"^.* +(=|<=|=>|<=>|/<=|<--) +.*$")
+
+def statement_op(line):
+    """Returns the operator of a rule or definition without parsing it
+
+    line -- the string that contains the rule or definition
+
+    returns -- '=' for definitions, the rule operator for rules and
+    None if the line looks like neither
+    """
+    m = rule_op_pattern.match(line.strip())
+    return m.group(1) if m else None
+
 def parse_rule(parser, line_nl, line_no, line_lst, start="expr_start"):
     """Parse one rule or definiton or any constituent given as start
 
@@ -411,16 +610,14 @@ def parse_rule(parser, line_nl, line_no, line_lst, start="expr_start"):
     # print(f"in parse_rule: {cfg.definitions.keys() = }") ####
     if (not line) or line[0] == '!':
         return "!", None, None  # it was a comment or an empty line
-    rulepat = r"^.* +(=|<=|=>|<=>|/<=|<--) +.*$"
     try:
-        m = re.match(rulepat, line)
-        if m:
-            # print("groups:", m.groups()) ####
-            if m.group(1) == '=':
+        op = statement_op(line)
+        if op:
+            if op == '=':
                 op, name, expr_fst = parser.parse(line, start='def_start',
                                                   semantics=TwolFstSemantics())
                 return op, name, expr_fst
-            elif m.group(1) in {'=>', '<=', '<=>', '/<=', '<--'}:
+            elif op in {'=>', '<=', '<=>', '/<=', '<--'}:
                 op, x_fst, contexts = parser.parse(line, start='rul_start',
                                                    semantics=TwolFstSemantics())
                 return op, x_fst, contexts
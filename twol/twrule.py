@@ -15,14 +15,24 @@ import twol.twbt as twbt
 
 import twol.twexamp as twexamp
 
-def init():
+base_file_name = ""
+"""The file where the base FSTs computed from the pair alphabet are
+stored between runs, empty if they are not stored"""
+
+base_ready = False
+
+def init(base_file=""):
     """Initializes the module by computing several common FSTs
-    
+
     Assumes that twexamp.read_fst() has read in cfg.examples_fst and
     initialized sone symbol sets.
+
+    base_file -- the name of a file where the base FSTs pistar_fst,
+    pistar_fsa, trim_pre_fst and trim_post_fst are stored.  The base
+    FSTs are loaded or computed only when the first rule is compiled,
+    see require_base().
     """
-    global pistar_fst, pistar_fsa, diamond_sym, diamond_fst
-    global trim_pre_fst, trim_post_fst
+    global diamond_sym, diamond_fst, base_file_name, base_ready
 
     assert cfg.examples_fst, "cfg.examples_fst not loaded (by twexamp module)"
 
@@ -31,6 +41,103 @@ def init():
 
     diamond_sym = 'DIAMOND'
     diamond_fst = hfst.regex(diamond_sym)
+    base_file_name = base_file
+    base_ready = False
+    context_memo.clear()
+    return
+
+def require_base():
+    """Makes sure that the base FSTs are available
+
+    The base FSTs are read from base_file_name if the file exists and
+    was made out of the same pair alphabet.  Otherwise, they are
+    computed and written into that file, if possible.
+    """
+    global base_ready
+    if base_ready:
+        return
+    if not (base_file_name and read_base(base_file_name)):
+        build_base()
+        if base_file_name:
+            write_base(base_file_name)
+    base_ready = True
+    return
+
+BASE_MAGIC = b"TWOLBASE1"
+"""The first bytes of a file written by write_base()"""
+
+def read_base(file_name):
+    """Reads the base FSTs from a file written by write_base()
+
+    Returns True if successful and False if the file does not exist,
+    was made for another pair alphabet or cannot be read.
+
+    The file starts with a header line which gives the digest of the
+    pair alphabet, the SHA-256 of the rest of the file and the lengths
+    of the four FSTs which follow in the HFST binary format.  The
+    contents are checked before any of them is given to HFST, because
+    HFST aborts the whole program on a truncated FST.
+    """
+    global pistar_fst, pistar_fsa, trim_pre_fst, trim_post_fst
+    import hashlib
+    try:
+        with open(file_name, "rb") as fil:
+            data = fil.read()
+        header, newline, body = data.partition(b"\n")
+        fields = header.decode("ascii").split()
+        if (len(fields) != 7 or fields[0] != BASE_MAGIC.decode("ascii") or
+            fields[1] != cfg.pair_alphabet_digest() or
+            fields[2] != hashlib.sha256(body).hexdigest()):
+            return False
+        fst_lst = []
+        start = 0
+        for length in [int(field) for field in fields[3:]]:
+            fst_lst.append(fs.bytes_to_fst(body[start:start + length]))
+            start += length
+    except (OSError, ValueError, hfst.exceptions.HfstException):
+        return False
+    pistar_fst, pistar_fsa, trim_pre_fst, trim_post_fst = fst_lst
+    if cfg.verbosity >= 5:
+        print("read base FSTs from", file_name)
+    return True
+
+def write_base(file_name):
+    """Writes the base FSTs into a file for read_base()
+
+    Nothing is written if the file cannot be written, e.g. because the
+    directory is read-only or missing.
+    """
+    import os
+    import hashlib
+    temp_name = "{}.{}.tmp".format(file_name, os.getpid())
+    try:
+        fst_bytes_lst = [fs.fst_to_bytes(fst)
+                         for fst in (pistar_fst, pistar_fsa,
+                                     trim_pre_fst, trim_post_fst)]
+        body = b"".join(fst_bytes_lst)
+        header = " ".join([BASE_MAGIC.decode("ascii"),
+                           cfg.pair_alphabet_digest(),
+                           hashlib.sha256(body).hexdigest()] +
+                          [str(len(fst_bytes))
+                           for fst_bytes in fst_bytes_lst])
+        with open(temp_name, "wb") as fil:
+            fil.write(header.encode("ascii") + b"\n")
+            fil.write(body)
+        os.replace(temp_name, file_name)
+    except (OSError, hfst.exceptions.HfstException):
+        if cfg.verbosity >= 5:
+            print("could not write base FSTs into", file_name)
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
+    return
+
+def build_base():
+    """Computes the base FSTs out of cfg.all_pairs_fst"""
+    global pistar_fst, pistar_fsa
+    global trim_pre_fst, trim_post_fst
+
     pi_fst = cfg.all_pairs_fst.copy()
     pistar_fst = cfg.all_pairs_fst.copy()
     pistar_fst.repeat_star()
@@ -176,6 +283,12 @@ def begin_end(expr_fst):
     # twbt.ppfst(result_fst, True) ##
     return(result_fst)
 
+context_memo = {}
+"""Conditions computed out of contexts, indexed by the AT&T form of the
+left and the right context"""
+
+context_memo_stats = {"hits": 0, "misses": 0}
+
 def context_to_condition(left_context_fst,
                          right_context_fst):
     """Convert one context into a condition (for the generalized restriction)
@@ -185,7 +298,32 @@ def context_to_condition(left_context_fst,
     right_context_fst -- the right context as an FST
     
     Returns [PI* LC ¤ PI* ¤ RC PI*] as an FST
+
+    The same contexts occur in many rules, so the conditions are
+    memoized in context_memo.
     """
+    key = (str(left_context_fst), str(right_context_fst))
+    if key in context_memo:
+        context_memo_stats["hits"] += 1
+        return context_memo[key].copy()
+    context_memo_stats["misses"] += 1
+    result_fst = compute_context_condition(left_context_fst,
+                                           right_context_fst)
+    context_memo[key] = result_fst.copy()
+    return result_fst
+
+def print_context_memo_stats():
+    """Prints how often the memoized context conditions were reused"""
+    hits = context_memo_stats["hits"]
+    misses = context_memo_stats["misses"]
+    total = hits + misses
+    print("context conditions: {} hits, {} misses ({:.0%} reused)".format(
+        hits, misses, hits / total if total else 0))
+    return
+
+def compute_context_condition(left_context_fst,
+                              right_context_fst):
+    """Computes [PI* LC ¤ PI* ¤ RC PI*] for context_to_condition()"""
     global pistar_fst, diamond_fst
     leftc_fst = pistar_fst.copy()
     leftc_fst.concatenate(left_context_fst)
@@ -207,20 +345,18 @@ def contexts_to_condition(*contexts):
     
     Each context in the list is converted separately and
     the result is the union of these and is returned as an FST.
+    The union is computed as a balanced tree by fs.union_lst()
+    instead of minimizing after adding each context.
     """
     global pistar_fst
-    result_fst = hfst.HfstTransducer()
-    for leftc, rightc in contexts:
-        #twbt.ppfst(leftc, title="leftc") ##
-        #twbt.ppfst(rightc, title="rightc") ##
-        context_fst = context_to_condition(leftc, rightc)
-        result_fst.disjunct(context_fst)
-        result_fst.minimize()
-        leftc_name = leftc.get_name()
-        rightc_name = rightc.get_name()
-        result_fst.set_name(leftc_name + "_" + rightc_name)
-        #twbt.ppfst(result_fst, title="result") ##
-    return(result_fst)
+    if not contexts:
+        return hfst.HfstTransducer()
+    context_fst_lst = [context_to_condition(leftc, rightc)
+                       for leftc, rightc in contexts]
+    result_fst = fs.union_lst(context_fst_lst)
+    leftc, rightc = contexts[-1]
+    result_fst.set_name(leftc.get_name() + "_" + rightc.get_name())
+    return result_fst
 
 def mix_output(x_fst):
     """Computes an FSA that is used when creating negative examples
@@ -271,7 +407,7 @@ def selector_from_x(x_fst):
     selector_fst.set_name("Selector " + x_fst.get_name())
     return selector_fst
 
-def correct_to_incorrect(x_fst, side):
+def correct_to_incorrect(x_fst, side, mixed_fsa=None):
     """used for creating negative examples for <= rules
     
     In order to make negative examples for <= rules we need to transform
@@ -284,13 +420,16 @@ def correct_to_incorrect(x_fst, side):
 
     side -- either "input" or "output"
 
+    mixed_fsa -- the result of mix_input(x_fst) or mix_output(x_fst)
+    if the caller has already computed it
+
     returns: an fst (encoded as a fsa) which maps correct examples into
     incorrect exs
     """
     global pistar_fst, pistar_fsa
-    if side == "input":
+    if mixed_fsa is None and side == "input":
         mixed_fsa = mix_input(x_fst)
-    else:
+    elif mixed_fsa is None:
         mixed_fsa = mix_output(x_fst)
     temp_encod_fsa = hfst.fst_to_fsa(x_fst, separator="^")
     temp_encod_fsa.cross_product(mixed_fsa) # now maps corr X to all variations
@@ -302,7 +441,7 @@ def correct_to_incorrect(x_fst, side):
     corr_to_incorr_encod_fst.set_name("Correct to incorrect")
     return corr_to_incorr_encod_fst
 
-def incorrect_to_correct(x_fst):
+def incorrect_to_correct(x_fst, mixed_fsa=None):
     """Compute a transformation for right-arrow (=>) rules
     
     In order to make negative examples for the => rules we need to
@@ -311,6 +450,9 @@ def incorrect_to_correct(x_fst):
     i.e. incorrect because it is in an unexpected context.
     
     x_fst -- FST for the center part (X) of a rule
+
+    mixed_fsa -- the result of mix_output(x_fst) if the caller has
+    already computed it
     
     Returns: scrambler_fst -- an encoded FST which maps encoded
     instances of X into all possible correct and incorrect pairs (where
@@ -319,7 +461,10 @@ def incorrect_to_correct(x_fst):
     """
     global pistar_fst, pistar_fsa
     x_encod_fsa = hfst.fst_to_fsa(x_fst, separator="^")
-    mix_fst = mix_output(x_fst) # still an encoded fsa
+    if mixed_fsa is None:
+        mix_fst = mix_output(x_fst) # still an encoded fsa
+    else:
+        mix_fst = mixed_fsa.copy()
     mix_fst.cross_product(x_encod_fsa) # now fst
     scrambler_fst = pistar_fsa.copy()
     scrambler_fst.concatenate(mix_fst)
@@ -328,6 +473,41 @@ def incorrect_to_correct(x_fst):
     scrambler_fst.set_name("Scrambler " + x_fst.get_name())
     return scrambler_fst
 
+def input_side_variants(x_fst):
+    """Returns [X.u .o. PI*], i.e. all pairs with the input side of X"""
+    global pistar_fst
+    x_all_fst = x_fst.copy()
+    x_all_fst.input_project()
+    x_all_fst.compose(pistar_fst)
+    return x_all_fst
+
+def output_side_variants(x_fst):
+    """Returns [PI* .o. X.l], i.e. all pairs with the output side of X"""
+    global pistar_fst
+    x_all_fst = pistar_fst.copy()
+    temp_fst = x_fst.copy()
+    temp_fst.output_project()
+    x_all_fst.compose(temp_fst)
+    return x_all_fst
+
+def coercion_rule(x_condition_fst, x_all_fst, context_condition_fst):
+    """Compiles the rule FST of a coercion rule (<= or <--)
+
+    x_condition_fst -- x_to_condition(X) where X is the center
+
+    x_all_fst -- all variants of X, i.e. input_side_variants(X) or
+    output_side_variants(X)
+
+    context_condition_fst -- contexts_to_condition() of the contexts
+
+    Returns the rule FST which requires that the variants of X in the
+    contexts are exactly X.
+    """
+    precondition_fst = x_to_condition(x_all_fst)
+    precondition_fst.intersect(context_condition_fst)
+    rule_fst = generalized_restriction(precondition_fst, x_condition_fst)
+    return rule_fst
+
 def rightarrow(name, x_fst, *contexts):
     """Compiles rules like X => [LC1,RC1),...(LCk,RCk)]
     
@@ -345,6 +525,7 @@ def rightarrow(name, x_fst, *contexts):
     
     scrambler_fst -- an encoded FST which produces negative examples
     """
+    require_base()
     precondition_fst = x_to_condition(x_fst)
     postcondition_fst = contexts_to_condition(*contexts)
     rule_fst = generalized_restriction(precondition_fst, postcondition_fst)
@@ -372,23 +553,15 @@ def output_coercion(name, x_fst, *contexts):
     
     scrambler_fst -- an encoded FST which produces negative examples
     """
-    global pistar_fst
-    postcondition_fst = x_to_condition(x_fst)
-    x_all_fst = x_fst.copy()
-    x_all_fst.input_project()
-    x_all_fst.compose(pistar_fst)
-    precondition_fst = x_to_condition(x_all_fst)
-    context_condition_fst = contexts_to_condition(*contexts)
-    precondition_fst.intersect(context_condition_fst)
-    rule_fst = generalized_restriction(precondition_fst, postcondition_fst)
+    require_base()
+    x_all_fst = input_side_variants(x_fst)
+    rule_fst = coercion_rule(x_to_condition(x_fst), x_all_fst,
+                             contexts_to_condition(*contexts))
     rule_fst.set_name(name)
     if cfg.verbosity >= 20:
         twbt.ppfst(rule_fst, True)
-    x_any_fst = x_fst.copy()
-    x_any_fst.input_project()
-    x_any_fst.compose(pistar_fst)
     ###x_any_fst.minus(x_fst)
-    selector_fst = selector_from_x(x_any_fst)
+    selector_fst = selector_from_x(x_all_fst)
     scrambler_fst = correct_to_incorrect(x_fst, "output")
     return rule_fst, selector_fst, scrambler_fst
 
@@ -410,16 +583,10 @@ def input_coercion(name, x_fst, *contexts):
     
     scrambler_fst -- an encoded FST which produces negative examples
     """
-    global pistar_fst
-    postcondition_fst = x_to_condition(x_fst)
-    x_all_fst = pistar_fst.copy()
-    temp_fst = x_fst.copy()
-    temp_fst.output_project()
-    x_all_fst.compose(temp_fst) # PI* .o. X.l
-    precondition_fst = x_to_condition(x_all_fst)
-    context_condition_fst = contexts_to_condition(*contexts)
-    precondition_fst.intersect(context_condition_fst)
-    rule_fst = generalized_restriction(precondition_fst, postcondition_fst)
+    require_base()
+    x_all_fst = output_side_variants(x_fst) # PI* .o. X.l
+    rule_fst = coercion_rule(x_to_condition(x_fst), x_all_fst,
+                             contexts_to_condition(*contexts))
     rule_fst.set_name(name)
     if cfg.verbosity >= 20:
         twbt.ppfst(rule_fst, True)
@@ -446,17 +613,27 @@ def doublearrow(name, x_fst, *contexts):
     
     scrambler_fst -- an encoded FST which produces negative examples
 
+    The result is the same as the combination of rightarrow() and
+    output_coercion() but the conditions which both of them need are
+    computed only once.  The selector of the => part is included in
+    the selector of the <= part.
     """
-    (rule_fst, selector_fst,
-     scrambler_fst) = rightarrow(name, x_fst, *contexts)
-    (rule2_fst, selector2_fst,
-     scrambler2_fst) = output_coercion(name, x_fst, *contexts)
+    require_base()
+    x_condition_fst = x_to_condition(x_fst)
+    context_condition_fst = contexts_to_condition(*contexts)
+    mixed_fsa = mix_output(x_fst)
+    x_all_fst = input_side_variants(x_fst)
+    rule_fst = generalized_restriction(x_condition_fst,
+                                       context_condition_fst)
+    rule2_fst = coercion_rule(x_condition_fst, x_all_fst,
+                              context_condition_fst)
     rule_fst.intersect(rule2_fst)
     rule_fst.minimize()
     rule_fst.set_name(name)
-    scrambler_fst.disjunct(scrambler2_fst)
+    scrambler_fst = incorrect_to_correct(x_fst, mixed_fsa)
+    scrambler_fst.disjunct(correct_to_incorrect(x_fst, "output", mixed_fsa))
     scrambler_fst.minimize()
-    selector_fst.disjunct(selector2_fst)
+    selector_fst = selector_from_x(x_all_fst)
     selector_fst.minimize()
     # twbt.ppfst(rule_fst, True) ##
     return rule_fst, selector_fst, scrambler_fst
@@ -478,6 +655,7 @@ def center_exclusion(name, x_fst, *contexts):
     
     scrambler_fst -- empty_fst (negative examples not relevant for these rules)
     """
+    require_base()
     context_condition_fst = contexts_to_condition(*contexts)
     x_condition_fst = x_to_condition(x_fst)
     context_condition_fst.intersect(x_condition_fst)
@@ -62,6 +62,12 @@ def main():
         help=("Print the weighst of the proposed entries,"
               " default is not to print"),
         action="store_true", default=False)
+    argparser.add_argument(
+        "-s", "--server",
+        help=("Unix socket of a running 'twol-generate --serve'"
+              " which generates the forms instead of loading"
+              " the rules, default is to load them"),
+        default="")
     argparser.add_argument(
         "-v", "--verbosity", type=int,
         help="level of diagnostic output",
@@ -75,9 +81,13 @@ def main():
     import re
     import sys
 
-    import twol.twgenerate as twgenerate
-
-    twgenerate.init(args.rules)
+    if args.server:
+        import twol.genserver as genserver
+        generate_many = genserver.Client(args.server).generate_many
+    else:
+        import twol.twgenerate as twgenerate
+        twgenerate.init(args.rules)
+        generate_many = twgenerate.generate_many
 
     import json
 
@@ -138,8 +148,8 @@ def main():
             i += 1
             suffix_lst = suffix_lst_dic.get(cont, [])
             word_lst = []
-            for suffix in suffix_lst:
-                generated_words = twgenerate.generate(stem+suffix)
+            for generated_words in generate_many(
+                    [stem + suffix for suffix in suffix_lst]):
                 for word in generated_words:
                     word = word.replace("Ø", "")
                     word_lst.append(word)